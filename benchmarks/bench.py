@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks for the NeoHub client, against a simulated hub.
+
+    $ python benchmarks/bench.py --output report.json
+    $ python benchmarks/bench.py --baseline report.json
+
+Writes a JSON report of every measurement; with --baseline, compares
+against an earlier report and exits non-zero if anything got worse by
+more than --threshold (default 20%) and by more than that metric's noise
+floor (0.5ms, or 50us for the microsecond timings). The suite runs
+--repeat times (default 5) and each metric keeps its best value, which
+takes out most scheduling noise.
+
+The simulated hub runs in the same process and event loop as the client,
+so absolute numbers include its share of the work. They're for comparing
+runs on the same machine, not for quoting.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from neohub import NeoHub
+from neohub.neohub import json_compare
+from neohub.simulator import SimulatedHub
+
+
+REPORT_VERSION = 1
+
+# stack depth tracemalloc records, so allocations made by the stdlib on
+# the client's behalf can be attributed to it
+_TRACE_FRAMES = 32
+
+# metric name suffix -> whether bigger numbers are better
+_HIGHER_IS_BETTER = {
+    "per_sec": True,
+    "_ms": False,
+    "_us": False,
+    "_bytes": False,
+    "_allocations": False,
+}
+
+# metric name suffix -> smallest absolute change that can count as a
+# regression: below these, run to run jitter swamps any real difference
+_NOISE_FLOORS = {
+    "_ms": 0.5,
+    "_us": 50,
+}
+
+# reported, but too noisy (or not a cost) to flag as regressions
+_INFORMATIONAL = frozenset(["polls_during_latency_run"])
+
+
+def higher_is_better(name):
+    for suffix, better in _HIGHER_IS_BETTER.items():
+        if name.endswith(suffix):
+            return better
+    return False
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+async def _setup(zones, latency):
+    sim = await SimulatedHub(stats=zones, plugs=0, latency=latency, seed=1).start(port=0)
+    # no rate limiting: we want to see what the stack itself can do
+    hub = NeoHub("127.0.0.1", sim.port, rate_limit=None, coalesce_window=0)
+    return sim, hub
+
+
+async def bench_calls(results, zones, latency, count, concurrency):
+    sim, hub = await _setup(zones, latency)
+    try:
+        await hub.async_setup()
+        q = {"FIRMWARE": 0}
+
+        start = time.perf_counter()
+        for i in range(count):
+            await hub.call(q)
+        results["call_serial_per_sec"] = count / (time.perf_counter() - start)
+
+        async def caller(n):
+            for i in range(n):
+                await hub.call(q)
+        start = time.perf_counter()
+        await asyncio.gather(*[caller(count // concurrency) for i in range(concurrency)])
+        results["call_concurrent_per_sec"] = (count // concurrency * concurrency) / (time.perf_counter() - start)
+    finally:
+        hub.close()
+        sim.close()
+
+
+async def bench_latency_under_polling(results, zones, latency, count):
+    """Command latency, while another task refreshes INFO/ENGINEERS_DATA
+    back to back"""
+    sim, hub = await _setup(zones, latency)
+    try:
+        await hub.async_setup()
+        polls = [0]
+
+        async def poll():
+            while True:
+                await hub.update(force_update=True)
+                polls[0] += 1
+
+        poller = asyncio.ensure_future(poll())
+        samples = []
+        q = {"READ_DCB": 100}
+        try:
+            for i in range(count):
+                start = time.perf_counter()
+                await hub.call(q)
+                samples.append((time.perf_counter() - start) * 1000)
+        finally:
+            poller.cancel()
+            try:
+                await poller
+            except asyncio.CancelledError:
+                pass
+        results["latency_polling_p50_ms"] = percentile(samples, 50)
+        results["latency_polling_p99_ms"] = percentile(samples, 99)
+        results["polls_during_latency_run"] = polls[0]
+    finally:
+        hub.close()
+        sim.close()
+
+
+def _client_filter():
+    # only count what the client allocates (eg in json.loads, on its
+    # behalf), not the simulated hub
+    package = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "neohub"))
+    return [
+        tracemalloc.Filter(True, os.path.join(package, "*"), all_frames=True),
+        tracemalloc.Filter(False, os.path.join(package, "simulator.py"), all_frames=True),
+    ]
+
+
+async def bench_size(results, zones, latency, repeat=5):
+    """Setup time and memory per device for one hub size"""
+    best = None
+    for i in range(repeat):
+        sim, hub = await _setup(zones, latency)
+        try:
+            start = time.perf_counter()
+            await hub.async_setup()
+            elapsed = time.perf_counter() - start
+        finally:
+            hub.close()
+            sim.close()
+        best = elapsed if best is None else min(best, elapsed)
+    results["setup_%d_zones_ms" % zones] = best * 1000
+
+    sim, hub = await _setup(zones, latency)
+    try:
+        gc.collect()
+        tracemalloc.start(_TRACE_FRAMES)
+        before = tracemalloc.take_snapshot().filter_traces(_client_filter())
+        await hub.async_setup()
+        gc.collect()
+        after = tracemalloc.take_snapshot().filter_traces(_client_filter())
+        tracemalloc.stop()
+        grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        results["memory_per_device_%d_zones_bytes" % zones] = grown / float(zones)
+
+        await bench_merge(results, zones, hub, sim)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        hub.close()
+        sim.close()
+
+
+async def bench_merge(results, zones, hub, sim, rounds=50):
+    """The INFO/ENGINEERS_DATA merge loop on its own, fed canned responses
+    so only the client's work is measured"""
+    responses = {"INFO": sim.handle({"INFO": 0}), "ENGINEERS_DATA": sim.handle({"ENGINEERS_DATA": 0})}
+    # alternate two temperatures so every round has changes to merge
+    flipped = json.loads(json.dumps(responses))
+    for dev in flipped["INFO"]["devices"]:
+        dev["CURRENT_TEMPERATURE"] = "%0.1f" % (float(dev["CURRENT_TEMPERATURE"]) + 0.5)
+    variants = [responses, flipped]
+    state = {"round": 0}
+    real_call = hub.call
+
+    async def canned_call(j, expecting=None):
+        cmd = next(iter(j))
+        if cmd in responses:
+            return variants[state["round"] % 2][cmd]
+        return await real_call(j, expecting)
+
+    async def merge():
+        state["round"] += 1
+        await hub.actual_update(queries)
+
+    hub.call = canned_call
+    unsubscribe = hub.subscribe(lambda changes: None)
+    queries = ["INFO", "ENGINEERS_DATA"]
+    try:
+        await merge()
+        times = []
+        gc.collect()
+        gc.disable()
+        try:
+            for i in range(rounds):
+                start = time.perf_counter()
+                await merge()
+                times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+
+        gc.collect()
+        tracemalloc.start()
+        start_size, start_peak = tracemalloc.get_traced_memory()
+        for i in range(rounds):
+            await merge()
+        gc.collect()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # blocks each merge allocates and doesn't free by the time it
+        # returns; with gc held off, that includes garbage in reference
+        # cycles, which costs a collection later
+        allocations = 0
+        tracemalloc.start(_TRACE_FRAMES)
+        gc.disable()
+        try:
+            for i in range(rounds):
+                before = tracemalloc.take_snapshot().filter_traces(_client_filter())
+                await merge()
+                after = tracemalloc.take_snapshot().filter_traces(_client_filter())
+                allocations += sum(max(0, stat.count_diff) for stat in after.compare_to(before, "lineno"))
+        finally:
+            gc.enable()
+            tracemalloc.stop()
+    finally:
+        unsubscribe()
+        hub.call = real_call
+
+    # best round, as timeit does: slower ones measure other noise
+    results["merge_%d_zones_us" % zones] = min(times) * 1e6
+    # allocated on the way through a merge, then freed
+    results["merge_%d_zones_peak_bytes" % zones] = peak - start_size
+    # still allocated afterwards: should hover around zero
+    results["merge_%d_zones_retained_bytes" % zones] = (size - start_size) / float(rounds)
+    results["merge_%d_zones_allocations" % zones] = allocations / float(rounds)
+
+
+def bench_micro(results, zones=100):
+    """json_compare/ordered and the NeoStat accessors"""
+    expecting = {"result": "temperature was set"}
+    response = {"result": "temperature was set"}
+    n = 100000
+    results["json_compare_per_sec"] = n / timeit.timeit(lambda: json_compare(response, expecting), number=n)
+    big = SimulatedHub(stats=zones, plugs=0, seed=1).handle({"INFO": 0})
+    n = 200
+    results["json_compare_info_%d_zones_per_sec" % zones] = n / timeit.timeit(lambda: json_compare(big, big), number=n)
+
+    async def loaded_hub():
+        sim, hub = await _setup(zones, 0)
+        await hub.async_setup()
+        hub.close()
+        sim.close()
+        return hub
+    hub = asyncio.get_event_loop().run_until_complete(loaded_hub())
+    stats = list(hub.neostats().values())
+
+    def read_all():
+        for stat in stats:
+            stat.current_temperature()
+            stat.set_temperature()
+            stat.currently_heating()
+            stat.is_frosted()
+    n = 200
+    results["neostat_reads_per_sec"] = n * len(stats) * 4 / timeit.timeit(read_all, number=n)
+
+
+def best_of(runs):
+    """Each metric's best value across several runs of the suite"""
+    results = {}
+    for run in runs:
+        for name, value in run.items():
+            if name not in results:
+                results[name] = value
+            elif higher_is_better(name):
+                results[name] = max(results[name], value)
+            else:
+                results[name] = min(results[name], value)
+    return results
+
+
+def run_once(args):
+    results = {}
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench_calls(results, args.zones, args.latency, args.calls, args.concurrency))
+    loop.run_until_complete(bench_latency_under_polling(results, args.zones, args.latency, args.calls // 4))
+    for zones in args.sizes:
+        loop.run_until_complete(bench_size(results, zones, args.latency))
+    bench_micro(results)
+    return results
+
+
+def run(args):
+    results = best_of([run_once(args) for i in range(args.repeat)])
+    return {
+        "version": REPORT_VERSION,
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "zones": args.zones,
+            "sizes": args.sizes,
+            "latency": args.latency,
+            "calls": args.calls,
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def noise_floor(name):
+    for suffix, floor in _NOISE_FLOORS.items():
+        if name.endswith(suffix):
+            return floor
+    return 0
+
+
+def compare(report, baseline, threshold):
+    """[(name, old, new, change, regressed)] for metrics in both reports.
+    change is the relative change, positive meaning better. A metric has
+    regressed if it got worse by more than threshold and by more than its
+    noise floor."""
+    rows = []
+    for name, new in sorted(report["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None or name in _INFORMATIONAL or name.endswith("_retained_bytes"):
+            continue
+        if old == 0:
+            change = 0.0
+        elif higher_is_better(name):
+            change = (new - old) / abs(old)
+        else:
+            change = (old - new) / abs(old)
+        rows.append((name, old, new, change, change < -threshold and abs(new - old) > noise_floor(name)))
+    return rows
+
+
+def print_results(report):
+    for name, value in sorted(report["results"].items()):
+        print("%-44s %14.2f" % (name, value))
+
+
+def print_comparison(rows):
+    print("%-44s %14s %14s %8s" % ("metric", "baseline", "now", "change"))
+    for name, old, new, change, regressed in rows:
+        print("%-44s %14.2f %14.2f %+7.1f%%%s" % (name, old, new, change * 100, "  REGRESSED" if regressed else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NeoHub client against a simulated hub")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against this earlier report")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fractional slowdown that counts as a regression (default 0.2)")
+    parser.add_argument("--zones", type=int, default=20, help="hub size for the call/latency benchmarks")
+    parser.add_argument("--sizes", default="10,100,1000", help="hub sizes for setup/memory/merge benchmarks")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated hub response time, seconds")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5, help="run everything this many times, keeping the best")
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        print_results(report)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(report, baseline, args.threshold)
+    print_comparison(rows)
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print("%d metric(s) regressed by more than %d%%" % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,8 +4,8 @@ homeassistant.components.thermostat.heatmiser_neohub
 
 Talks to neohub, controls neostat zigbee thermostats and neoplugs
 """
-import asyncio
 import logging
+from datetime import timedelta
 
 import voluptuous as vol
 
@@ -24,6 +24,7 @@ from homeassistant.components.switch import SwitchDevice
 from homeassistant.const import DEVICE_DEFAULT_NAME
 
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.event import async_track_time_interval
 
 import socket
 import json
@@ -40,6 +41,8 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_PORT): cv.port,
 })
 
+SCAN_INTERVAL = timedelta(seconds=15)
+
 SUPPORT_FLAGS = (SUPPORT_TARGET_TEMPERATURE | SUPPORT_TARGET_TEMPERATURE_HIGH |
                  SUPPORT_TARGET_TEMPERATURE_LOW | SUPPORT_OPERATION_MODE |
                  SUPPORT_AWAY_MODE)
@@ -51,25 +54,81 @@ async def async_setup_platform(hass, config, async_add_devices, discovery_info=N
     port = config.get("CONF_PORT", 4242)
     hub = NeoHub(host, port)
     await hub.async_setup()
+    coordinator = NeoHubCoordinator(hass, hub)
 
     plugs = hub.neoplugs()
     stats = hub.neostats()
-    neoplugs = [NeoPlugSwitch(plugs[name], None, False) for name in plugs]
-    neostats = [NeoStatDevice(stats[name]) for name in stats]
+    neoplugs = [NeoPlugSwitch(plugs[name], coordinator, None, False) for name in plugs]
+    neostats = [NeoStatDevice(stats[name], coordinator) for name in stats]
     async_add_devices(neoplugs)
     async_add_devices(neostats)
+    coordinator.start()
     _LOGGER.info("Added %s plugs, %s stats" % (len(plugs), len(stats)))
 
 
+class NeoHubCoordinator(object):
+    """ Polls the hub once per interval on behalf of every entity, and
+    pushes state to just the entities whose device changed. """
+    def __init__(self, hass, hub, interval=SCAN_INTERVAL):
+        self._hass = hass
+        self._hub = hub
+        self._interval = interval
+        self._entities = {}
+        self._refresh_handle = None
+        hub.subscribe(self._changed)
+
+    def start(self):
+        async_track_time_interval(self._hass, self._poll, self._interval)
+
+    def add_entity(self, entity):
+        self._entities.setdefault(entity.name, []).append(entity)
+
+    async def _poll(self, now=None):
+        # The coordinator sets the pace, so every tick refreshes INFO
+        # (rather than some landing just inside its cache and skipping a
+        # poll); ENGINEERS_DATA keeps its own, slower, cadence.
+        try:
+            await self._hub.update(force_update=["INFO"])
+        except Exception:
+            _LOGGER.exception("Failed to update from NeoHub")
+
+    def _changed(self, changes):
+        for name in set(change.device for change in changes):
+            for entity in self._entities.get(name, []):
+                entity.async_schedule_update_ha_state()
+
+    def request_refresh(self, secs=1.5):
+        """ Refresh from the hub in secs, eg after a write. Requests made
+        while one is already pending are folded into it. """
+        if self._refresh_handle is not None:
+            return
+        self._refresh_handle = self._hass.loop.call_later(secs, self._delayed_refresh)
+
+    def _delayed_refresh(self):
+        self._refresh_handle = None
+        _LOGGER.info("updating after write")
+        self._hass.async_add_job(self._refresh())
+
+    async def _refresh(self):
+        try:
+            await self._hub.update(force_update=True)
+        except Exception:
+            _LOGGER.exception("Failed to update from NeoHub")
+
+
 class NeoStatDevice(ClimateDevice):
     """ Represents a Heatmiser Neostat thermostat. """
-    def __init__(self, n):
+    def __init__(self, n, coordinator):
         self._neo = n
+        self._coordinator = coordinator
+
+    async def async_added_to_hass(self):
+        self._coordinator.add_entity(self)
 
     @property
     def should_poll(self):
-        """ No polling needed for a demo thermostat. """
-        return True
+        """ The coordinator polls the hub and pushes state to us. """
+        return False
 
     @property
     def name(self):
@@ -109,13 +168,8 @@ class NeoStatDevice(ClimateDevice):
         return self._neo.is_frosted()
 
     def update_after(self, secs):
-        async def wait_and_update():
-            await asyncio.sleep(secs)
-            _LOGGER.info("updating after delay of %s" % (secs))
-            await self.async_update()
-            #self.async_schedule_update_ha_state()
-
-        asyncio.ensure_future(wait_and_update())
+        self.async_schedule_update_ha_state()
+        self._coordinator.request_refresh(secs)
 
     async def async_set_temperature(self, **kwargs):
         """ Set new target temperature. """
@@ -133,9 +187,6 @@ class NeoStatDevice(ClimateDevice):
         await self._neo.set_frost_off()
         self.update_after(1.5)
 
-    async def async_update(self):
-        await self._neo.update()
-
     @property
     def supported_features(self):
         """Return the list of supported features."""
@@ -144,17 +195,21 @@ class NeoStatDevice(ClimateDevice):
 
 
 class NeoPlugSwitch(SwitchDevice):
-    def __init__(self, neo, icon, assumed):
+    def __init__(self, neo, coordinator, icon, assumed):
         _LOGGER.debug("Neo Switch: %s" % repr(neo))
         self._neo = neo
+        self._coordinator = coordinator
         self._state = neo.is_on()
         self._icon = icon
         self._assumed = assumed
 
+    async def async_added_to_hass(self):
+        self._coordinator.add_entity(self)
+
     @property
     def should_poll(self):
-        """No polling needed for a demo switch."""
-        return True
+        """The coordinator polls the hub and pushes state to us."""
+        return False
 
     @property
     def name(self):
@@ -170,9 +225,6 @@ class NeoPlugSwitch(SwitchDevice):
         """Return if the state is based on assumptions."""
         return self._assumed
 
-    async def async_update(self):
-        await self._neo.update()
-
     @property
     def is_on(self):
         return self._neo.is_on()
@@ -191,11 +243,6 @@ class NeoPlugSwitch(SwitchDevice):
         #await self.async_schedule_update_ha_state()
 
     def update_after(self, secs):
-        async def wait_and_update():
-            await asyncio.sleep(secs)
-            _LOGGER.info("updating after delay of %s" % (secs))
-            await self.async_update()
-            #self.async_schedule_update_ha_state()
-
-        asyncio.ensure_future(wait_and_update())
+        self.async_schedule_update_ha_state()
+        self._coordinator.request_refresh(secs)
 
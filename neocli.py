@@ -4,9 +4,12 @@ import sys
 import argparse
 import json
 import logging
+import shlex
 import socket
 import os
-from neohub import NeoHub, NeoDevice
+import time
+from neohub import NeoHub, NeoDevice, TemplogStore
+from neohub import analytics
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -19,91 +22,283 @@ def ok(what):
         print(repr(what))
         return 1
 
-async def main(neo, cmd, args):
-    await neo.async_setup()
 
-    if cmd == "call":
-        print(json.dumps(await neo.call(json.loads(args[0])), sort_keys=True, indent=2))
-        return 0
+# name -> (handler, needs device state, show)
+#
+# handler(neo, args) returns the command's result. Commands that don't need
+# device state (anything that just names zones, or a raw call) skip the
+# INFO/ENGINEERS_DATA setup entirely. show(result) prints the result for a
+# person and returns the exit code; in batch mode results are written as
+# JSON lines instead.
+COMMANDS = {}
 
-    if cmd == "stat":
-        print(json.dumps((await neo.update())[args[0]], sort_keys=True, indent=2))
-        return 0
 
-    if cmd == "set_diff":
-        return ok(await neo.set_diff(args[0], args[1]))
+def command(name, needs_state=False, show=ok):
+    def register(handler):
+        COMMANDS[name] = (handler, needs_state, show)
+        return handler
+    return register
 
-    if cmd == "switch_on":
-        return (await neo.neoplugs()[args[0]].switch_on())
 
-    if cmd == "switch_off":
-        return (await neo.neoplugs()[args[0]].switch_off())
+def show_json(result):
+    print(json.dumps(result, sort_keys=True, indent=2))
+    return 0
 
-    if cmd == "script":
-        p = neo.neoplugs()["F1 Hall Plug"]
-        print(repr(p))
-        await p.switch_off()
-        print(repr(p))
-        await p.switch_on()
-        print(repr(p))
 
-    if cmd == "rename_zone":
-        return ok(await neo.zone_title(args[0], args[1]))
+def show_lines(result):
+    for line in result:
+        print(line)
+    return 0
 
-    if cmd == "remove_zone":
-        return ok(await neo.remove_zone(args[0]))
 
-    # pass 4 digits as PIN
-    if cmd == "lock":
-        pin_str = args[1]
-        return ok(await neo.set_locked(args[0], pin_str))
+def show_text(result):
+    print(result, end="" if result.endswith("\n") else "\n")
+    return 0
 
-    if cmd == "unlock":
-        return ok(await neo.set_unlocked(args[0]))
 
-    if cmd == "frost_on":
-        return ok(await neo.frost_on(args[0]))
+class Session(object):
+    """One hub connection, set up on first need"""
+    def __init__(self, neo):
+        self.neo = neo
+        self._setup = None
 
-    if cmd == "frost_off":
-        return ok(await neo.frost_off(args[0]))
+    async def ensure_setup(self):
+        if self._setup is None:
+            self._setup = asyncio.ensure_future(self.neo.async_setup())
+        await self._setup
 
-    if cmd == "set_program_mode":
-        return ok(await neo.set_program_mode(args[0]))
+    async def run(self, cmd, args):
+        if cmd not in COMMANDS:
+            raise KeyError("unknown command %r" % cmd)
+        handler, needs_state, show = COMMANDS[cmd]
+        if needs_state:
+            await self.ensure_setup()
+        return await handler(self.neo, args)
 
-    if cmd == "set_temp":
-        return ok(await neo.set_temp(args[0], args[1]))
 
-    if cmd == "set_cool_temp":
-        return ok(await neo.set_cool_temp(args[0], args[1]))
+@command("call", show=show_json)
+async def call(neo, args):
+    return await neo.call(json.loads(args[0]))
 
-    if cmd == "list":
-        for name in neo.neostats():
-            ns = neo.neostats()[name]
-            print(repr(ns))
-        print("")
-        for name in neo.neoplugs():
-            ns = neo.neoplugs()[name]
-            print(repr(ns))
-        return 0
 
-    if cmd == "list-stats":
-        for name in neo.neostats():
-            ns = neo.neostats()[name]
-            print(repr(ns))
-        return 0
+@command("stat", needs_state=True, show=show_json)
+async def stat(neo, args):
+    return dict((await neo.update())[args[0]])
 
-    if cmd == "stat-names":
-        for name in neo.neostats():
-            print(name)
-        return 0
 
-    if cmd == "list-plugs":
-        for name in neo.neoplugs():
-            ns = neo.neoplugs()[name]
-            print(repr(ns))
-        return 0
+@command("set_diff")
+async def set_diff(neo, args):
+    return await neo.set_diff(args[0], args[1])
+
+
+@command("switch_on", needs_state=True)
+async def switch_on(neo, args):
+    return await neo.neoplugs()[args[0]].switch_on()
+
+
+@command("switch_off", needs_state=True)
+async def switch_off(neo, args):
+    return await neo.neoplugs()[args[0]].switch_off()
+
+
+@command("script", needs_state=True, show=lambda result: 1)
+async def script(neo, args):
+    p = neo.neoplugs()["F1 Hall Plug"]
+    print(repr(p))
+    await p.switch_off()
+    print(repr(p))
+    await p.switch_on()
+    print(repr(p))
+
+
+@command("rename_zone")
+async def rename_zone(neo, args):
+    return await neo.zone_title(args[0], args[1])
+
+
+@command("remove_zone")
+async def remove_zone(neo, args):
+    return await neo.remove_zone(args[0])
+
+
+# pass 4 digits as PIN
+@command("lock")
+async def lock(neo, args):
+    pin_str = args[1]
+    return await neo.set_locked(args[0], pin_str)
+
+
+@command("unlock")
+async def unlock(neo, args):
+    return await neo.set_unlocked(args[0])
+
+
+@command("frost_on")
+async def frost_on(neo, args):
+    return await neo.frost_on(args[0])
+
 
-    return 1
+@command("frost_off")
+async def frost_off(neo, args):
+    return await neo.frost_off(args[0])
+
+
+@command("set_program_mode")
+async def set_program_mode(neo, args):
+    return await neo.set_program_mode(args[0])
+
+
+@command("comfort", needs_state=True, show=show_json)
+async def comfort(neo, args):
+    return await neo.read_comfort_levels(args[0])
+
+
+def show_plan(plan):
+    for profile, zones in plan:
+        print("%s: %s" % (", ".join(zones), json.dumps(profile, sort_keys=True)))
+    if not plan:
+        print("Nothing to change")
+    return 0
+
+
+# apply_comfort <file.json> [dry-run]: brings zones' programs to those in the
+# file, {zone, group or "*": {day: {level: [time, temperature]}}}, sending
+# only what differs
+@command("apply_comfort", needs_state=True, show=show_plan)
+async def apply_comfort(neo, args):
+    with open(args[0]) as f:
+        desired = json.load(f)
+    return await neo.sync_comfort_levels(desired, dry_run=args[1:2] == ["dry-run"])
+
+
+@command("set_temp")
+async def set_temp(neo, args):
+    return await neo.set_temp(args[0], args[1])
+
+
+@command("set_cool_temp")
+async def set_cool_temp(neo, args):
+    return await neo.set_cool_temp(args[0], args[1])
+
+
+# analytics [history_dir|-] [seconds to watch heating for duty cycle]
+@command("analytics", needs_state=True, show=lambda metrics: show_text(analytics.format_table(metrics)))
+async def analytics_(neo, args):
+    histories = []
+    if args and args[0] != "-":
+        store = TemplogStore(args[0])
+        await store.sync(neo, list(neo.neostats()))
+        histories = [store.load(zone) for zone in store.zones()]
+        series = dict((h.zone, h.values) for h in histories)
+    else:
+        series = analytics.templog_arrays(await neo.get_templog(list(neo.neostats())))
+    duty_cycles = None
+    if len(args) > 1:
+        recorder = analytics.DutyCycleRecorder(neo)
+        end = time.time() + float(args[1])
+        while time.time() < end:
+            await asyncio.sleep(min(15, max(0, end - time.time())))
+            await neo.update(force_update=True)
+        duty_cycles = recorder.duty_cycles()
+    try:
+        return analytics.zone_metrics(neo, series, duty_cycles)
+    finally:
+        for h in histories:
+            h.close()
+
+
+def show_metrics(result):
+    return show_json(result) if isinstance(result, dict) else show_text(result)
+
+
+# metrics [json]: Prometheus text (or JSON) after a couple of refreshes
+@command("metrics", needs_state=True, show=show_metrics)
+async def metrics(neo, args):
+    await neo.update()
+    await neo.update(force_update=True)
+    if args and args[0] == "json":
+        return neo.metrics_snapshot()
+    return neo.metrics_text()
+
+
+@command("list", needs_state=True, show=show_lines)
+async def list_(neo, args):
+    return ([repr(ns) for ns in neo.neostats().values()] + [""] +
+            [repr(ns) for ns in neo.neoplugs().values()])
+
+
+@command("list-stats", needs_state=True, show=show_lines)
+async def list_stats(neo, args):
+    return [repr(ns) for ns in neo.neostats().values()]
+
+
+@command("stat-names", needs_state=True, show=show_lines)
+async def stat_names(neo, args):
+    return list(neo.neostats())
+
+
+@command("list-plugs", needs_state=True, show=show_lines)
+async def list_plugs(neo, args):
+    return [repr(ns) for ns in neo.neoplugs().values()]
+
+
+def parse_line(line):
+    """A batch line as (cmd, args): either JSON, ["cmd", "arg", ...] or
+    {"cmd": ..., "args": [...]}, or words as on the command line, eg
+    frost_on "Master Bedroom". None for blank lines and # comments."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line[0] in "[{":
+        j = json.loads(line)
+        words = [j["cmd"]] + list(j.get("args", [])) if isinstance(j, dict) else j
+    else:
+        words = shlex.split(line)
+    # handlers take string arguments, as from the command line
+    return words[0], [a if isinstance(a, str) else json.dumps(a) for a in words[1:]]
+
+
+async def batch(session, lines, out):
+    """Runs each line's command in turn over the session's one connection,
+    writing a JSON line per command to out. Returns 0 if they all
+    succeeded."""
+    failed = 0
+    for n, line in enumerate(lines, 1):
+        record = {"line": n}
+        try:
+            parsed = parse_line(line)
+            if parsed is None:
+                continue
+            record["cmd"], record["args"] = parsed
+            result = await session.run(*parsed)
+        except Exception as e:
+            record["ok"] = False
+            record["error"] = "%s: %s" % (type(e).__name__, e)
+        else:
+            # writes return True, or None if the hub didn't confirm them
+            record["ok"] = result is not None and result is not False
+            record["result"] = result
+        if not record["ok"]:
+            failed += 1
+        out.write(json.dumps(record, default=str) + "\n")
+        out.flush()
+    return 1 if failed else 0
+
+
+async def main(neo, cmd, args):
+    session = Session(neo)
+
+    # batch [file|-]: one command per line, results as JSON lines
+    if cmd == "batch":
+        if args and args[0] != "-":
+            with open(args[0]) as f:
+                return await batch(session, f, sys.stdout)
+        return await batch(session, sys.stdin, sys.stdout)
+
+    if cmd not in COMMANDS:
+        return 1
+    result = await session.run(cmd, args)
+    return COMMANDS[cmd][2](result)
 
 
 
@@ -115,12 +310,14 @@ if __name__ == '__main__':
         sys.exit(1)
 
     loop = asyncio.get_event_loop()
-    neo = NeoHub(host, 4242)
+    # nothing else is writing to coalesce with, so don't wait to
+    neo = NeoHub(host, 4242, coalesce_window=0)
 
     cmd = sys.argv[1]
     args = sys.argv[2:]
     retval = loop.run_until_complete(main(neo, cmd, args))
+    neo.close()
+    # let the connection's reader task finish cancelling
+    loop.run_until_complete(asyncio.sleep(0))
     loop.close()
     sys.exit(retval)
-
-
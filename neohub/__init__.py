@@ -1,11 +1,27 @@
 import logging
 
+from . import changes
+from . import connection
+from . import exceptions
 from . import neodevice
 from . import neoplug
 from . import neostat
 from . import neohub
+from . import fleet
+from . import history
+from . import index
+from . import statetable
 
 NeoDevice = neodevice.NeoDevice
 NeoPlug = neoplug.NeoPlug
 NeoStat = neostat.NeoStat
 NeoHub = neohub.NeoHub
+NeoHubFleet = fleet.NeoHubFleet
+NeoConnection = connection.NeoConnection
+Change = changes.Change
+StateTable = statetable.StateTable
+ZoneIndex = index.ZoneIndex
+TemplogStore = history.TemplogStore
+NeoHubError = exceptions.NeoHubError
+NeoHubConnectionError = exceptions.NeoHubConnectionError
+NeoHubTimeout = exceptions.NeoHubTimeout
@@ -0,0 +1,176 @@
+"""Heating analytics over temperature history and polled state.
+
+Metrics are computed per zone, for all zones in one batch. The per-reading
+work is done with map()/filter()/compress() over the float arrays from the
+history store (or a fresh GET_TEMPLOG), using builtin and operator
+functions, so the inner loops run in C rather than in Python bytecode.
+
+Only the current set temperatures are known, not what they were in the
+past, so the metrics comparing readings against them (overshoots(),
+at_target()) look at the most recent day by default.
+"""
+import array
+import functools
+import itertools
+import math
+import operator
+import time
+
+from .history import READINGS_PER_DAY, INTERVAL_SECONDS
+
+
+_READINGS_PER_HOUR = 3600 / INTERVAL_SECONDS
+
+
+def _readings(values, days=None):
+    # NaN != NaN, so this drops the gaps; days keeps just the latest days
+    if days:
+        values = values[-days * READINGS_PER_DAY:]
+    return list(itertools.compress(values, map(operator.eq, values, values)))
+
+
+def templog_arrays(templog):
+    """{zone: array of floats}, oldest reading first, from a raw GET_TEMPLOG
+    response ("day:N" being N days ago)"""
+    days = []
+    for key, readings in templog.items():
+        if key == "today":
+            days.append((0, readings))
+        elif key.startswith("day:"):
+            days.append((int(key[4:]), readings))
+    days.sort(key=lambda d: -d[0])
+
+    zones = {}
+    for age, readings in days:
+        for zone, values in readings.items():
+            out = zones.setdefault(zone, array.array("d"))
+            for v in values[:READINGS_PER_DAY]:
+                try:
+                    out.append(float(v))
+                except (TypeError, ValueError):
+                    out.append(math.nan)
+    return zones
+
+
+def warmup_rates(series):
+    """{zone: mean rise in degrees per hour, over the intervals where the
+    temperature rose}"""
+    rates = {}
+    for zone, values in series.items():
+        rises = list(filter(functools.partial(operator.lt, 0.0), map(operator.sub, values[1:], values[:-1])))
+        rates[zone] = sum(rises) / len(rises) * _READINGS_PER_HOUR if rises else 0.0
+    return rates
+
+
+def overshoots(series, set_temperatures, days=1):
+    """{zone: how far the highest reading went over the set temperature},
+    over the last days of readings (all of them if None). The set
+    temperature is the current one, so readings from before it last
+    changed are measured against the wrong target: keep days short."""
+    result = {}
+    for zone, values in series.items():
+        target = set_temperatures.get(zone)
+        readings = _readings(values, days)
+        if target is None or not readings:
+            continue
+        result[zone] = max(0.0, max(readings) - target)
+    return result
+
+
+def at_target(series, set_temperatures, tolerance=0.5, days=1):
+    """{zone: fraction of readings within tolerance of, or above, the set
+    temperature}, over the last days of readings, as for overshoots(). A
+    stand-in for preheat effectiveness: a zone that preheats well spends
+    little time below target."""
+    result = {}
+    for zone, values in series.items():
+        target = set_temperatures.get(zone)
+        readings = _readings(values, days)
+        if target is None or not readings:
+            continue
+        threshold = target - tolerance
+        result[zone] = sum(map(threshold.__le__, readings)) / len(readings)
+    return result
+
+
+class DutyCycleRecorder(object):
+    """Accumulates how long each stat spends heating, from the HEATING
+    changes seen by the hub's refreshes"""
+    def __init__(self, hub):
+        now = time.time()
+        self._started = now
+        self._heating_since = {}
+        self._on_time = {}
+        for name, stat in hub.neostats().items():
+            self._on_time[name] = 0.0
+            if stat.currently_heating():
+                self._heating_since[name] = now
+        self._unsubscribe = hub.subscribe(self._changed)
+
+    def _changed(self, changes):
+        now = time.time()
+        for change in changes:
+            if change.field != "HEATING" or change.device not in self._on_time:
+                continue
+            if change.new and change.device not in self._heating_since:
+                self._heating_since[change.device] = now
+            elif not change.new and change.device in self._heating_since:
+                self._on_time[change.device] += now - self._heating_since.pop(change.device)
+
+    def duty_cycles(self):
+        """{zone: fraction of the time since recording started spent heating}"""
+        now = time.time()
+        elapsed = now - self._started
+        if elapsed <= 0:
+            return {}
+        return dict((name, (on + (now - self._heating_since[name] if name in self._heating_since else 0)) / elapsed)
+                    for name, on in self._on_time.items())
+
+    def close(self):
+        self._unsubscribe()
+
+
+def zone_metrics(hub, series, duty_cycles=None):
+    """{zone: {metric: value}} for every NeoStat, from series ({zone: floats},
+    see templog_arrays() or TemplogStore.load()) and optionally duty cycles
+    from a DutyCycleRecorder"""
+    stats = hub.neostats()
+    set_temperatures = dict((name, stat.set_temperature()) for name, stat in stats.items())
+    series = dict((zone, values) for zone, values in series.items() if zone in stats)
+
+    rates = warmup_rates(series)
+    over = overshoots(series, set_temperatures)
+    target = at_target(series, set_temperatures)
+    duty_cycles = duty_cycles or {}
+
+    metrics = {}
+    for name, stat in stats.items():
+        metrics[name] = {
+            "temperature": stat.current_temperature(),
+            "set_temperature": set_temperatures[name],
+            "duty_cycle": duty_cycles.get(name),
+            "warmup_rate": rates.get(name),
+            "overshoot": over.get(name),
+            "at_target": target.get(name),
+        }
+    return metrics
+
+
+def format_table(metrics):
+    """metrics from zone_metrics() as a text table"""
+    def fmt(value, spec):
+        return "-" if value is None else spec % value
+
+    lines = ["%-20s %6s %6s %6s %9s %9s %9s" % ("zone", "temp", "set", "duty", "warmup/h", "overshoot", "at target")]
+    for name in sorted(metrics):
+        m = metrics[name]
+        lines.append("%-20s %6s %6s %6s %9s %9s %9s" % (
+            name[:20],
+            fmt(m["temperature"], "%0.1f"),
+            fmt(m["set_temperature"], "%0.1f"),
+            fmt(m["duty_cycle"] and m["duty_cycle"] * 100, "%0.0f%%"),
+            fmt(m["warmup_rate"], "%0.2f"),
+            fmt(m["overshoot"], "%0.1f"),
+            fmt(m["at_target"] and m["at_target"] * 100, "%0.0f%%"),
+        ))
+    return "\n".join(lines)
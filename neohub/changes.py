@@ -0,0 +1,92 @@
+import asyncio
+import collections
+import logging
+
+
+# One field of one device that changed between two refreshes. old is None
+# the first time a field is seen.
+Change = collections.namedtuple("Change", ["device", "field", "old", "new"])
+
+
+class ChangeFeed(object):
+    """Fans out the changes found by each refresh to subscribers.
+
+    Callbacks registered with subscribe() are called synchronously with the
+    list of changes from each refresh. watch() returns an async iterator of
+    individual changes, buffering up to maxsize of them; if a watcher falls
+    behind, the oldest buffered changes are dropped.
+    """
+    def __init__(self):
+        self._callbacks = []
+        self._streams = []
+
+    def __bool__(self):
+        return bool(self._callbacks or self._streams)
+
+    def subscribe(self, callback):
+        """Calls callback(changes) after every refresh that changed something.
+        Returns a function that unsubscribes it again."""
+        self._callbacks.append(callback)
+
+        def unsubscribe():
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+        return unsubscribe
+
+    def watch(self, maxsize=1024):
+        stream = ChangeStream(self, maxsize)
+        self._streams.append(stream)
+        return stream
+
+    def publish(self, changes):
+        if not changes:
+            return
+        for callback in list(self._callbacks):
+            try:
+                callback(changes)
+            except Exception:
+                logging.exception("NeoHub change callback %r failed", callback)
+        for stream in self._streams:
+            stream._put(changes)
+
+    def _remove(self, stream):
+        if stream in self._streams:
+            self._streams.remove(stream)
+
+
+class ChangeStream(object):
+    """async for change in hub.watch(): ..."""
+    def __init__(self, feed, maxsize):
+        self._feed = feed
+        self._buffer = collections.deque(maxlen=maxsize)
+        self._waiter = None
+        self._closed = False
+        self.dropped = 0
+
+    def _put(self, changes):
+        overflow = len(self._buffer) + len(changes) - self._buffer.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+        self._buffer.extend(changes)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def close(self):
+        self._closed = True
+        self._feed._remove(self)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._buffer:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._buffer.popleft()
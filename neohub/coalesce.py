@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import json
+
+
+# Commands that take <device(s)> (optionally preceded by a value) and so can
+# be fanned-in to one array command. Maps command -> (field, has_value).
+# Commands sharing a field overwrite each other, eg FROST_ON then FROST_OFF
+# for the same device within the window only sends the FROST_OFF.
+COALESCABLE = {
+    "SET_TEMP":      ("SET_TEMP", True),
+    "SET_COOL_TEMP": ("SET_COOL_TEMP", True),
+    "SET_FROST":     ("SET_FROST", True),
+    "SET_DIFF":      ("SET_DIFF", True),
+    "SET_PREHEAT":   ("SET_PREHEAT", True),
+    "BOOST_ON":      ("BOOST", True),
+    "BOOST_OFF":     ("BOOST", True),
+    "LOCK":          ("LOCK", True),
+    "UNLOCK":        ("LOCK", False),
+    "FROST_ON":      ("FROST", False),
+    "FROST_OFF":     ("FROST", False),
+    "AWAY_ON":       ("AWAY", False),
+    "AWAY_OFF":      ("AWAY", False),
+    "TIMER_ON":      ("TIMER", False),
+    "TIMER_OFF":     ("TIMER", False),
+}
+
+
+class _PendingWrite(object):
+    __slots__ = ("cmd", "value", "value_key", "expecting", "futures")
+
+    def __init__(self, cmd, value, value_key, expecting):
+        self.cmd = cmd
+        self.value = value
+        self.value_key = value_key
+        self.expecting = expecting
+        self.futures = []
+
+
+class WriteCoalescer(object):
+    """Holds writes for a short window, then sends them as array commands.
+
+    Pending writes with the same command and value are merged into one
+    command addressed to all their devices, and a later write to the same
+    device and field replaces an earlier one. Every caller still gets its
+    own result: a superseded write resolves with the result of the write
+    that replaced it.
+    """
+    def __init__(self, call, window=0.05):
+        self._call = call
+        self._window = window
+        self._pending = collections.OrderedDict()
+        self._flush_handle = None
+
+    async def write(self, q, expecting=None):
+        cmd, = q.keys()
+        if not self._window or cmd not in COALESCABLE:
+            return await self._call(q, expecting=expecting)
+
+        field, has_value = COALESCABLE[cmd]
+        if has_value:
+            value, device = q[cmd]
+        else:
+            value, device = None, q[cmd]
+        value_key = json.dumps(value, sort_keys=True)
+
+        loop = asyncio.get_event_loop()
+        futures = []
+        for dev in (device if isinstance(device, list) else [device]):
+            write = _PendingWrite(cmd, value, value_key, expecting)
+            previous = self._pending.pop((field, dev), None)
+            if previous is not None:
+                write.futures.extend(previous.futures)
+            fut = loop.create_future()
+            write.futures.append(fut)
+            self._pending[(field, dev)] = write
+            futures.append(fut)
+
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self._schedule_flush)
+
+        results = await asyncio.gather(*futures)
+        if all(results):
+            return True
+
+    def _schedule_flush(self):
+        self._flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Send everything pending now"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, collections.OrderedDict()
+
+        batches = collections.OrderedDict()
+        for (field, dev), write in pending.items():
+            batches.setdefault((write.cmd, write.value_key), []).append((dev, write))
+        await asyncio.gather(*[self._send(batch) for batch in batches.values()])
+
+    async def _send(self, batch):
+        first = batch[0][1]
+        devices = [dev for dev, write in batch]
+        target = devices if len(devices) > 1 else devices[0]
+        if COALESCABLE[first.cmd][1]:
+            q = {first.cmd: [first.value, target]}
+        else:
+            q = {first.cmd: target}
+
+        try:
+            result = await self._call(q, expecting=first.expecting)
+        except Exception as e:
+            for dev, write in batch:
+                for fut in write.futures:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        for dev, write in batch:
+            for fut in write.futures:
+                if not fut.done():
+                    fut.set_result(result)
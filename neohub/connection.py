@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+
+from .exceptions import NeoHubConnectionError
+from .framer import FrameSplitter
+
+
+class NeoConnection(object):
+    """One TCP connection to the hub's legacy JSON API.
+
+    The hub answers commands strictly in the order it receives them, with
+    each response terminated by a NUL byte. So rather than have every caller
+    take turns reading from the socket, we write requests as they arrive and
+    a single reader task hands each response frame to the oldest pending
+    request. Several commands can be in flight at once, and callers can't
+    trample each other's frames.
+    """
+    def __init__(self, host, port, max_inflight=8):
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = collections.deque()
+        self._slots = asyncio.Semaphore(max_inflight)
+        self.framer = FrameSplitter()
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def request(self, payload, timeout=None):
+        """Send one encoded request, return (response text, frame size)
+
+        Raises asyncio.TimeoutError if no response arrives within timeout
+        seconds. A request that times out, or whose caller is cancelled,
+        keeps its place in the queue so its response is read and discarded
+        when it does arrive. If it was the oldest request, though, the hub is
+        stuck on it (eg never sent the terminator) so the connection is
+        reset rather than left out of sync.
+        """
+        async with self._slots:
+            if self._writer is None:
+                raise NeoHubConnectionError("Not connected to NeoHub")
+            fut = asyncio.get_event_loop().create_future()
+            # no await between queueing the future and writing the bytes,
+            # so the order of self._pending always matches the wire order.
+            self._pending.append(fut)
+            self._writer.write(payload)
+            try:
+                return await asyncio.wait_for(self._drain_and_wait(fut), timeout)
+            except asyncio.TimeoutError:
+                if self._pending and self._pending[0] is fut:
+                    logging.warning("NeoHub stopped responding, resetting connection")
+                    self._shutdown(NeoHubConnectionError("NeoHub connection reset after a timeout"))
+                raise
+
+    async def _drain_and_wait(self, fut):
+        await self._writer.drain()
+        return await fut
+
+    async def _read_loop(self):
+        framer = self.framer
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                for frame, size in framer.feed(data):
+                    if frame:
+                        self._deliver(frame, size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("NeoHub connection failed: %r", e)
+            self._reader_task = None
+            self._shutdown(NeoHubConnectionError("NeoHub connection failed: %r" % e))
+            return
+        # EOF: the hub rebooted, or dropped the legacy API socket
+        self._reader_task = None
+        self._shutdown(NeoHubConnectionError("NeoHub closed the connection"))
+
+    def _deliver(self, frame, size):
+        if not self._pending:
+            logging.warning("Unsolicited frame from NeoHub: %s", frame)
+            return
+        fut = self._pending.popleft()
+        if not fut.done():
+            fut.set_result((frame, size))
+
+    def _fail_pending(self, exc):
+        while self._pending:
+            fut = self._pending.popleft()
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def close(self):
+        self._shutdown(NeoHubConnectionError("NeoHub connection closed"))
+
+    def _shutdown(self, exc):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(exc)
+
+
+class ConnectionSupervisor(object):
+    """Keeps one NeoConnection to the hub up.
+
+    Any request finding the connection down triggers a reconnect, shared by
+    everyone waiting at the time. The first attempt after a healthy
+    connection is immediate; after a failed attempt, further attempts back
+    off exponentially, with jitter, and requests in the meantime fail fast
+    rather than queueing up behind a dead hub.
+    """
+    def __init__(self, host, port, min_backoff=0.1, max_backoff=30):
+        self._host = host
+        self._port = port
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff = 0
+        self._next_attempt = 0
+        self._reconnect_task = None
+        self.conn = None
+        self.reconnects = 0
+
+    async def connection(self):
+        if self.conn is not None and self.conn.connected:
+            return self.conn
+        if self._reconnect_task is None:
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+            self._reconnect_task.add_done_callback(self._reconnect_done)
+        return await asyncio.shield(self._reconnect_task)
+
+    def _reconnect_done(self, task):
+        self._reconnect_task = None
+
+    async def _reconnect(self):
+        wait = self._next_attempt - time.time()
+        if wait > 0:
+            raise NeoHubConnectionError("NeoHub at %s:%s unreachable, retrying in %0.1fs" % (self._host, self._port, wait))
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.reconnects += 1
+        conn = NeoConnection(self._host, self._port)
+        try:
+            await conn.connect()
+        except OSError as e:
+            self._backoff = min(self._max_backoff, max(self._min_backoff, self._backoff * 2))
+            self._next_attempt = time.time() + self._backoff * random.uniform(0.5, 1.0)
+            raise NeoHubConnectionError("Could not connect to NeoHub at %s:%s: %s" % (self._host, self._port, e)) from e
+        logging.debug("Connected to NeoHub at %s:%s", self._host, self._port)
+        self._backoff = 0
+        self._next_attempt = 0
+        self.conn = conn
+        return conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,17 @@
+import asyncio
+
+
+class NeoHubError(Exception):
+    """Base class for errors talking to a NeoHub"""
+
+
+class NeoHubConnectionError(NeoHubError, ConnectionError):
+    """The connection to the hub is down, or was lost mid-command"""
+
+
+class NeoHubTimeout(NeoHubError, asyncio.TimeoutError):
+    """The hub didn't answer a command within its deadline"""
+
+
+class NeoHubScheduleError(NeoHubError, ValueError):
+    """A comfort level profile isn't in a form the hub would accept"""
@@ -0,0 +1,198 @@
+import asyncio
+import collections.abc
+import logging
+import multiprocessing
+import random
+
+from .neohub import NeoHub
+
+
+class NeoHubFleet(object):
+    """Owns connections to many NeoHubs, eg one per property.
+
+    hubs is a dict of {hub_id: (host, port)}. Hubs are set up and polled
+    concurrently, but never more than max_concurrency at once, and each poll
+    is delayed by a random 0..jitter seconds so hundreds of hubs don't all
+    fire in the same instant.
+
+    Devices are addressed by (hub_id, device_name).
+
+    With processes=N, the hubs are sharded across N worker processes, each
+    running its own event loop, so one core doesn't limit a large estate.
+    max_concurrency is then split between them (at least one each).
+    """
+    def __init__(self, hubs, max_concurrency=16, jitter=1.0, processes=0, **hub_kwargs):
+        self._addresses = dict(hubs)
+        self._max_concurrency = max_concurrency
+        self._jitter = jitter
+        self._hub_kwargs = hub_kwargs
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.errors = {}
+        self.hubs = {}
+        self._shards = []
+        self._devices = {}
+        if processes:
+            ids = sorted(self._addresses)
+            shards = [dict((hub_id, self._addresses[hub_id]) for hub_id in ids[n::processes])
+                      for n in range(processes)]
+            shards = [shard for shard in shards if shard]
+            # each process has its own semaphore: share the limit out
+            per_shard = max(1, max_concurrency // max(1, len(shards)))
+            for shard in shards:
+                self._shards.append(_Shard(shard, per_shard, jitter, hub_kwargs))
+        else:
+            for hub_id, (host, port) in self._addresses.items():
+                self.hubs[hub_id] = NeoHub(host, port, **hub_kwargs)
+
+    async def _guarded(self, hub_id, coro, jitter=0):
+        if jitter:
+            await asyncio.sleep(random.uniform(0, jitter))
+        async with self._semaphore:
+            try:
+                result = await coro
+            except Exception as e:
+                logging.warning("NeoHub %s failed: %r", hub_id, e)
+                self.errors[hub_id] = e
+                return e
+            self.errors.pop(hub_id, None)
+            return result
+
+    async def _each(self, method, args, hub_ids=None, jitter=0):
+        hub_ids = list(self.hubs) if hub_ids is None else [h for h in hub_ids if h in self.hubs]
+        results = await asyncio.gather(*[
+            self._guarded(hub_id, getattr(self.hubs[hub_id], method)(*args), jitter)
+            for hub_id in hub_ids])
+        return dict(zip(hub_ids, results))
+
+    async def _each_shard(self, method, args, hub_ids=None):
+        # only shards holding some of hub_ids get the command at all
+        shards = [shard for shard in self._shards
+                  if hub_ids is None or any(h in shard.hub_ids for h in hub_ids)]
+        msg = (method, args, None if hub_ids is None else list(hub_ids))
+        results = {}
+        for shard_results in await asyncio.gather(*[shard.request(msg) for shard in shards]):
+            results.update(shard_results)
+        for hub_id, result in results.items():
+            if isinstance(result, Exception):
+                self.errors[hub_id] = result
+            else:
+                self.errors.pop(hub_id, None)
+        return results
+
+    async def async_setup(self):
+        """Connects to and loads every hub. A hub that fails is recorded in
+        self.errors rather than failing the whole fleet."""
+        if self._shards:
+            for shard in self._shards:
+                shard.start()
+            await self._each_shard("async_setup", ())
+            return
+        await self._each("async_setup", ())
+
+    async def update(self, force_update=False):
+        """Polls every hub, returns the merged devices()"""
+        if self._shards:
+            self._devices = {}
+            for hub_id, devices in (await self._each_shard("update", (force_update,))).items():
+                if not isinstance(devices, Exception):
+                    for name, dev in devices.items():
+                        self._devices[(hub_id, name)] = dev
+            return self._devices
+        await self._each("update", (force_update,), jitter=self._jitter)
+        return self.devices()
+
+    def devices(self):
+        """{(hub_id, device_name): device dict} across the whole fleet"""
+        if self._shards:
+            return self._devices
+        merged = {}
+        for hub_id, hub in self.hubs.items():
+            for name, dev in hub.devices.items():
+                merged[(hub_id, name)] = dev
+        return merged
+
+    def device(self, hub_id, name):
+        return self.devices()[(hub_id, name)]
+
+    async def call(self, method, *args, hubs=None):
+        """Runs NeoHub.<method>(*args) on every hub (or just the hub ids in
+        hubs) in parallel. Returns {hub_id: result}, where a hub that failed
+        has the exception as its result."""
+        if self._shards:
+            return await self._each_shard(method, args, hubs)
+        return await self._each(method, args, hubs)
+
+    def close(self):
+        for hub in self.hubs.values():
+            hub.close()
+        for shard in self._shards:
+            shard.stop()
+
+
+class _Shard(object):
+    """A worker process running a NeoHubFleet over a subset of the hubs,
+    driven over a pipe."""
+    def __init__(self, hubs, max_concurrency, jitter, hub_kwargs):
+        self._hubs = hubs
+        self._args = (max_concurrency, jitter, hub_kwargs)
+        self._conn = None
+        self._process = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def hub_ids(self):
+        return self._hubs
+
+    def start(self):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_shard_main, args=(child, self._hubs) + self._args, daemon=True)
+        self._process.start()
+
+    def _roundtrip(self, msg):
+        self._conn.send(msg)
+        return self._conn.recv()
+
+    async def request(self, msg):
+        async with self._lock:
+            return await asyncio.get_event_loop().run_in_executor(None, self._roundtrip, msg)
+
+    def stop(self):
+        if self._process is not None:
+            try:
+                self._conn.send(None)
+            except (OSError, EOFError):
+                pass
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+
+def _shard_main(conn, hubs, max_concurrency, jitter, hub_kwargs):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    fleet = NeoHubFleet(hubs, max_concurrency, jitter, **hub_kwargs)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        method, args, hub_ids = msg
+        results = loop.run_until_complete(fleet._each(method, args, hub_ids,
+                                                      jitter=jitter if method == "update" else 0))
+        conn.send(dict((hub_id, _picklable(result)) for hub_id, result in results.items()))
+    fleet.close()
+    # let the connections' reader tasks finish cancelling
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def _picklable(result):
+    # device dicts are plain data; NeoStat/NeoPlug objects and the like
+    # can't cross the process boundary
+    if isinstance(result, collections.abc.Mapping):
+        return dict((k, _picklable(v)) for k, v in result.items())
+    if isinstance(result, (list, tuple)):
+        return [_picklable(v) for v in result]
+    if isinstance(result, Exception) or result is None or isinstance(result, (str, int, float, bool)):
+        return result
+    return repr(result)
@@ -0,0 +1,76 @@
+import json
+
+
+# Constant queries, eg {"INFO": 0}, are sent on every poll. Encode them once.
+_encoded_constants = {}
+
+
+def encode_frame(j):
+    """Encodes one command for the wire: JSON, NUL terminated"""
+    if len(j) == 1:
+        (cmd, arg), = j.items()
+        if type(arg) is int and arg == 0:
+            payload = _encoded_constants.get(cmd)
+            if payload is None:
+                payload = _encoded_constants[cmd] = (json.dumps(j) + "\0\r").encode("utf-8")
+            return payload
+    return (json.dumps(j) + "\0\r").encode("utf-8")
+
+
+class FrameSplitter(object):
+    """Incrementally splits the hub's byte stream into NUL terminated frames.
+
+    Bytes are accumulated in one bytearray and only the newly received bytes
+    are scanned for the terminator. Each complete frame is decoded exactly
+    once, so multi-byte UTF-8 characters split across reads (accented zone
+    names) come through intact.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        self._scanned = 0
+        self.frames = 0
+        self.bytes = 0
+        self.last_frame_size = 0
+        self.max_frame_size = 0
+
+    def feed(self, data):
+        """Adds received bytes, returns a list of (text, size) for each
+        frame completed by them"""
+        buf = self._buf
+        buf += data
+        end = buf.find(b"\0", self._scanned)
+        if end < 0:
+            self._scanned = len(buf)
+            return []
+
+        frames = []
+        start = 0
+        view = memoryview(buf)
+        try:
+            while end >= 0:
+                size = end - start
+                frames.append((str(view[start:end], "utf-8").strip(), size))
+                self.frames += 1
+                self.bytes += size
+                self.last_frame_size = size
+                if size > self.max_frame_size:
+                    self.max_frame_size = size
+                start = end + 1
+                end = buf.find(b"\0", start)
+        finally:
+            view.release()
+        del buf[:start]
+        self._scanned = len(buf)
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes belonging to an incomplete frame"""
+        return len(self._buf)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "last_frame_size": self.last_frame_size,
+            "max_frame_size": self.max_frame_size,
+        }
@@ -0,0 +1,198 @@
+import array
+import datetime
+import json
+import math
+import mmap
+import os
+
+from .exceptions import NeoHubError
+from .snapshot import atomic_write
+
+
+# The hub logs one temperature every 15 minutes
+READINGS_PER_DAY = 96
+INTERVAL_SECONDS = 24 * 60 * 60 // READINGS_PER_DAY
+
+INDEX_VERSION = 1
+
+
+class ZoneHistory(object):
+    """A zone's stored temperatures: one float per 15 minute slot, from
+    first_day (a date ordinal) onwards, NaN where there's no reading.
+
+    values is a memoryview straight onto the memory-mapped file, so
+    loading months of history costs no copying or parsing. close() when
+    done with it.
+    """
+    def __init__(self, zone, first_day, mm):
+        self.zone = zone
+        self.first_day = first_day
+        self._mm = mm
+        self.values = memoryview(mm).cast("d") if mm is not None else memoryview(array.array("d"))
+
+    @property
+    def days(self):
+        return len(self.values) // READINGS_PER_DAY
+
+    def day(self, day):
+        """The 96 readings for one date ordinal (or datetime.date), as a
+        view onto the file. It keeps the file mapped, even past close(),
+        until it's released."""
+        if isinstance(day, datetime.date):
+            day = day.toordinal()
+        start = (day - self.first_day) * READINGS_PER_DAY
+        if start < 0 or start >= len(self.values):
+            raise KeyError(day)
+        return self.values[start:start + READINGS_PER_DAY]
+
+    def close(self):
+        self.values.release()
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # day() views still use it; it's unmapped once they're gone
+                pass
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TemplogStore(object):
+    """Keeps the hub's GET_TEMPLOG history on disk, in directory.
+
+    Each zone's readings live in their own file of native doubles, 96 per
+    day, contiguous from the zone's first stored day, with an index.json
+    alongside. sync() merges a fresh GET_TEMPLOG into it: past days already
+    stored are skipped, so after the first sync only "today", and the day
+    before if that was stored part way through, get rewritten.
+    """
+    def __init__(self, directory):
+        self._dir = directory
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+            if self._index.get("version") != INDEX_VERSION:
+                raise ValueError("unknown templog index version %r" % self._index.get("version"))
+        except FileNotFoundError:
+            self._index = {"version": INDEX_VERSION, "next": 0, "zones": {}}
+
+    def zones(self):
+        return list(self._index["zones"])
+
+    def _save_index(self):
+        atomic_write(self._index_path, json.dumps(self._index, separators=(",", ":")))
+
+    def _stored(self, entry):
+        # "stored" has a "1" per day actually stored, "0" for the blank days
+        # padding gaps. Indexes from before it was kept count a day as
+        # stored if it has any readings.
+        if "stored" not in entry:
+            values = array.array("d")
+            with open(os.path.join(self._dir, entry["file"]), "rb") as f:
+                values.frombytes(f.read())
+            entry["stored"] = "".join(
+                "0" if all(math.isnan(v) for v in values[i:i + READINGS_PER_DAY]) else "1"
+                for i in range(0, entry["days"] * READINGS_PER_DAY, READINGS_PER_DAY))
+        return entry["stored"]
+
+    def has_day(self, zone, day):
+        entry = self._index["zones"].get(zone)
+        if entry is None or not entry["first_day"] <= day < entry["first_day"] + entry["days"]:
+            return False
+        return self._stored(entry)[day - entry["first_day"]] == "1"
+
+    def store_day(self, zone, day, readings):
+        """Writes one day's readings for zone, growing its file as needed"""
+        values = array.array("d", [math.nan] * READINGS_PER_DAY)
+        for i, reading in enumerate(readings[:READINGS_PER_DAY]):
+            try:
+                values[i] = float(reading)
+            except (TypeError, ValueError):
+                pass
+
+        entry = self._index["zones"].get(zone)
+        if entry is None:
+            entry = self._index["zones"][zone] = {
+                "file": "zone-%d.f64" % self._index["next"], "first_day": day, "days": 0, "stored": ""}
+            self._index["next"] += 1
+        path = os.path.join(self._dir, entry["file"])
+        blank_day = array.array("d", [math.nan] * READINGS_PER_DAY).tobytes()
+        stored = self._stored(entry)
+
+        if day < entry["first_day"]:
+            # an older day than any stored: shift everything along, in a new
+            # file, as a ZoneHistory may have the old one mapped
+            gap = entry["first_day"] - day - 1
+            with open(path, "rb") as f:
+                old = f.read()
+            atomic_write(path, values.tobytes() + blank_day * gap + old)
+            entry["stored"] = "1" + "0" * gap + stored
+            entry["days"] += gap + 1
+            entry["first_day"] = day
+            return
+
+        offset = day - entry["first_day"]
+        with open(path, "ab") as f:
+            # fill any gap since the last stored day
+            if offset > entry["days"]:
+                f.write(blank_day * (offset - entry["days"]))
+        with open(path, "r+b") as f:
+            f.seek(offset * READINGS_PER_DAY * values.itemsize)
+            f.write(values.tobytes())
+        stored = stored.ljust(offset, "0")
+        entry["stored"] = stored[:offset] + "1" + stored[offset + 1:]
+        entry["days"] = max(entry["days"], offset + 1)
+
+    def merge_templog(self, templog, today=None):
+        """Stores a GET_TEMPLOG response. "day:N" is taken as N days before
+        today. "today" is always rewritten, as is each zone's latest stored
+        day, which may have been stored as "today" with only part of its
+        readings; other days only if missing."""
+        if today is None:
+            today = datetime.date.today()
+        today = today.toordinal()
+
+        days = []
+        for key, readings in templog.items():
+            if key == "today":
+                days.append((today, readings))
+            elif key.startswith("day:"):
+                days.append((today - int(key[4:]), readings))
+        # oldest first, so files only ever grow at the end
+        days.sort(key=lambda d: d[0])
+
+        latest = dict((zone, entry["first_day"] + entry["days"] - 1)
+                      for zone, entry in self._index["zones"].items() if entry["days"])
+        for day, readings in days:
+            for zone, values in readings.items():
+                if day != today and day != latest.get(zone) and self.has_day(zone, day):
+                    continue
+                self.store_day(zone, day, values)
+        self._save_index()
+
+    async def sync(self, hub, devices=None, today=None):
+        """Fetches GET_TEMPLOG for devices (default: every NeoStat on the
+        hub) and merges it in"""
+        if devices is None:
+            devices = list(hub.neostats())
+        templog = await hub.get_templog(devices)
+        if "error" in templog:
+            raise NeoHubError("Couldn't read temperature logs for %s: %s" % (devices, templog["error"]))
+        self.merge_templog(templog, today)
+
+    def load(self, zone):
+        """A zone's history as a ZoneHistory over the memory-mapped file"""
+        entry = self._index["zones"][zone]
+        path = os.path.join(self._dir, entry["file"])
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ZoneHistory(zone, entry["first_day"], None)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return ZoneHistory(zone, entry["first_day"], mm)
@@ -0,0 +1,162 @@
+import unicodedata
+
+
+def normalize(name):
+    """The form names are looked up by: case folded, accents and repeated
+    whitespace dropped, so "Séjour", "sejour" and "SEJOUR " are one zone"""
+    decomposed = unicodedata.normalize("NFKD", str(name))
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+class ZoneIndex(object):
+    """Zone names, the hub's numeric zone ids (from GET_ZONES) and groups
+    (from GET_GROUPS), mapped both ways.
+
+    Names can be looked up however they're cased or accented. Group
+    membership is kept as frozensets, both group -> members and member ->
+    groups, so expanding or testing membership is a dict lookup.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._names = {}
+        self._normalized = {}
+        self._groups = {}
+        self._group_names = {}
+        self._member_of = {}
+        self.groups_loaded = False
+
+    # -- zones
+
+    def update_zones(self, zones):
+        """Replaces the zones with a GET_ZONES response, {name: id}"""
+        self._ids = dict(zones)
+        self._names = dict((zone_id, name) for name, zone_id in zones.items())
+        self._normalized = dict((normalize(name), name) for name in zones)
+        # drop members that aren't zones any more
+        if self._groups:
+            self.update_groups(self._groups)
+
+    def renamed_zones(self, zones):
+        """[(old name, new name)] for zones in a fresh GET_ZONES response
+        that kept their id but changed name"""
+        renames = []
+        for name, zone_id in zones.items():
+            old = self._names.get(zone_id)
+            if old is not None and old != name and old not in zones:
+                renames.append((old, name))
+        return renames
+
+    def rename(self, old, new):
+        zone_id = self._ids.pop(old, None)
+        if zone_id is not None:
+            self._ids[new] = zone_id
+            self._names[zone_id] = new
+        self._normalized.pop(normalize(old), None)
+        self._normalized[normalize(new)] = new
+        if old in self._member_of:
+            groups = self._member_of.pop(old)
+            self._member_of[new] = groups
+            for group in groups:
+                self._groups[group] = frozenset(new if m == old else m for m in self._groups[group])
+
+    def names(self):
+        return list(self._ids)
+
+    def id_of(self, name):
+        return self._ids.get(self.name(name))
+
+    def name_of(self, zone_id):
+        return self._names.get(zone_id)
+
+    def name(self, key):
+        """The zone's name as the hub spells it, for a name (in any case or
+        accents) or zone id. None if there's no such zone."""
+        if isinstance(key, int) and not isinstance(key, bool):
+            return self._names.get(key)
+        if key in self._ids:
+            return key
+        return self._normalized.get(normalize(key))
+
+    def __contains__(self, key):
+        return self.name(key) is not None
+
+    def __len__(self):
+        return len(self._ids)
+
+    # -- groups
+
+    def update_groups(self, groups):
+        """Replaces the groups with a GET_GROUPS response, {group: [names]}"""
+        self._groups = {}
+        self._group_names = {}
+        self._member_of = {}
+        for group, members in groups.items():
+            self.add_group(group, members)
+        self.groups_loaded = True
+
+    def add_group(self, group, members):
+        names = frozenset(filter(None, (self.name(m) for m in members)))
+        self.remove_group(group)
+        self._groups[group] = names
+        self._group_names[normalize(group)] = group
+        for name in names:
+            self._member_of[name] = self._member_of.get(name, frozenset()) | {group}
+
+    def remove_group(self, group):
+        group = self.group(group) or group
+        for name in self._groups.pop(group, ()):
+            self._member_of[name] = self._member_of[name] - {group}
+        self._group_names.pop(normalize(group), None)
+
+    def groups(self):
+        """{group: frozenset of member names}"""
+        return dict(self._groups)
+
+    def group(self, key):
+        """A group's name as the hub spells it, or None"""
+        if key in self._groups:
+            return key
+        if isinstance(key, str):
+            return self._group_names.get(normalize(key))
+        return None
+
+    def members(self, group):
+        return self._groups.get(self.group(group), frozenset())
+
+    def groups_of(self, name):
+        return self._member_of.get(self.name(name), frozenset())
+
+    # -- command targets
+
+    def resolve(self, target):
+        """Canonical form of a <device(s)> argument: zone names (or ids)
+        become the hub's spelling of the name, groups the hub's spelling of
+        the group. Anything unknown is passed through for the hub to judge.
+        Lists stay lists."""
+        if isinstance(target, (list, tuple)):
+            return [self.resolve(t) for t in target]
+        return self.name(target) or self.group(target) or target
+
+    def expand(self, target):
+        """The set of zone names a <device(s)> argument addresses, or None
+        if any part of it isn't a known zone or group"""
+        names = set()
+        for t in (target if isinstance(target, (list, tuple)) else [target]):
+            name = self.name(t)
+            if name is not None:
+                names.add(name)
+                continue
+            group = self.group(t)
+            if group is None:
+                return None
+            names.update(self._groups[group])
+        return names
+
+    def to_ids(self, target):
+        """target with zone names swapped for their (shorter) zone ids;
+        groups and unknown names are left as they are"""
+        if isinstance(target, (list, tuple)):
+            return [self.to_ids(t) for t in target]
+        zone_id = self._ids.get(target)
+        return target if zone_id is None else zone_id
@@ -0,0 +1,170 @@
+import bisect
+import collections
+
+
+# Upper bounds of the histogram buckets; anything bigger lands in +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+    """Counts of observations per bucket, plus their sum: enough for
+    percentiles and averages, at the cost of one bisect per observation"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(upper bound, observations <= it)], ending with +Inf"""
+        out = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+    def quantile(self, q):
+        """Estimate of the q-quantile: the upper bound of the bucket it falls
+        in (the largest bound, if in +Inf). None with no observations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound if bound != float("inf") else self.bounds[-1]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict((_number(bound), total) for bound, total in self.cumulative()),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """Counters and histograms for one hub's traffic. Recording is a dict
+    lookup and an add or two, cheap enough to leave on all the time."""
+    def __init__(self):
+        self.latency = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.frame_size = collections.defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.refresh_duration = Histogram(LATENCY_BUCKETS)
+        self.bytes_sent = collections.Counter()
+        self.bytes_received = collections.Counter()
+        self.errors = collections.Counter()
+        self.unexpected = collections.Counter()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def command(self, cmd, seconds, sent, received):
+        """Records one completed command"""
+        self.latency[cmd].observe(seconds)
+        self.frame_size[cmd].observe(received)
+        self.bytes_sent[cmd] += sent
+        self.bytes_received[cmd] += received
+
+    def error(self, cmd, kind):
+        """Records a failed command; kind is eg "timeout", "connection" or
+        "malformed" """
+        self.errors[(cmd, kind)] += 1
+
+    def snapshot(self, gauges=None):
+        """Everything as a plain dict, eg for JSON. gauges are point-in-time
+        values owned by the caller, passed through as they are."""
+        hits, misses = self.cache_hits, self.cache_misses
+        return {
+            "latency": dict((cmd, h.snapshot()) for cmd, h in self.latency.items()),
+            "frame_size": dict((cmd, h.snapshot()) for cmd, h in self.frame_size.items()),
+            "refresh_duration": self.refresh_duration.snapshot(),
+            "bytes_sent": dict(self.bytes_sent),
+            "bytes_received": dict(self.bytes_received),
+            "errors": dict(("%s:%s" % key, n) for key, n in self.errors.items()),
+            "unexpected_responses": dict(self.unexpected),
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "cache_hit_ratio": hits / float(hits + misses) if hits + misses else None,
+            "gauges": dict(gauges or {}),
+        }
+
+    def prometheus(self, prefix="neohub", labels=None, gauges=None):
+        """The Prometheus text exposition format. labels (eg {"hub": host})
+        are added to every sample; gauges is {name: value}."""
+        out = _PrometheusWriter(prefix, labels)
+        out.histogram("command_latency_seconds", "Round trip time of commands to the hub", "command", self.latency)
+        out.histogram("response_size_bytes", "Size of response frames from the hub", "command", self.frame_size)
+        out.histogram("refresh_duration_seconds", "Time taken by INFO/ENGINEERS_DATA refreshes", None,
+                      {None: self.refresh_duration})
+        out.counter("sent_bytes_total", "Bytes sent to the hub", "command", self.bytes_sent)
+        out.counter("received_bytes_total", "Bytes received from the hub", "command", self.bytes_received)
+        out.header("command_errors_total", "Commands that failed", "counter")
+        for (cmd, kind), n in sorted(self.errors.items()):
+            out.sample("command_errors_total", {"command": cmd, "kind": kind}, n)
+        out.counter("unexpected_responses_total", "Responses that didn't match what was expected", "command",
+                    self.unexpected)
+        out.header("update_cache_total", "update() calls served from cache (hit) or the hub (miss)", "counter")
+        out.sample("update_cache_total", {"result": "hit"}, self.cache_hits)
+        out.sample("update_cache_total", {"result": "miss"}, self.cache_misses)
+        for name, value in sorted((gauges or {}).items()):
+            out.header(name, None, "counter" if name.endswith("_total") else "gauge")
+            out.sample(name, {}, value)
+        return out.text()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _PrometheusWriter(object):
+    def __init__(self, prefix, labels):
+        self._prefix = prefix
+        self._labels = dict(labels or {})
+        self._lines = []
+
+    def header(self, name, help, kind):
+        name = "%s_%s" % (self._prefix, name)
+        if help:
+            self._lines.append("# HELP %s %s" % (name, help))
+        self._lines.append("# TYPE %s %s" % (name, kind))
+
+    def sample(self, name, labels, value):
+        labels = dict(self._labels, **labels)
+        label_text = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+        self._lines.append("%s_%s%s %s" % (self._prefix, name, "{%s}" % label_text if label_text else "",
+                                            _number(value)))
+
+    def counter(self, name, help, label, counts):
+        self.header(name, help, "counter")
+        for key, n in sorted(counts.items()):
+            self.sample(name, {label: key}, n)
+
+    def histogram(self, name, help, label, histograms):
+        self.header(name, help, "histogram")
+        for key, h in sorted(histograms.items(), key=lambda item: str(item[0])):
+            labels = {label: key} if label else {}
+            for bound, total in h.cumulative():
+                self.sample(name + "_bucket", dict(labels, le=_number(bound)), total)
+            self.sample(name + "_sum", labels, h.sum)
+            self.sample(name + "_count", labels, h.count)
+
+    def text(self):
+        return "\n".join(self._lines) + "\n"
@@ -12,6 +12,9 @@ class NeoDevice(object):
         await self.hub.update()
 
     def __getitem__(self, key):
+        # reading a field we wrote to, but the hub hasn't yet confirmed,
+        # kicks off a refresh in the background
+        self.hub.is_stale(self.name, key)
         return self.hub.devices[self.name][key]
 
     def __setitem__(self, key, val):
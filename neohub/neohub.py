@@ -1,65 +1,352 @@
 import asyncio
+import functools
 import json
 import socket
 import logging
 import time
+from .changes import ChangeFeed
+from .coalesce import COALESCABLE, WriteCoalescer
+from .connection import ConnectionSupervisor
+from .exceptions import NeoHubError, NeoHubConnectionError, NeoHubTimeout, NeoHubScheduleError
+from .framer import encode_frame
+from .index import ZoneIndex
+from .metrics import Metrics
+from .snapshot import load_snapshot, save_snapshot
+from .statetable import StateTable
+from .scheduler import CommandScheduler, command_priority, PRIORITY_WRITE
+from .schedule import normalize_profile, plan_changes
+from .polling import AdaptiveInterval
 from .neostat import NeoStat
 from .neoplug import NeoPlug
 
 
+# Commands that only read from the hub, so are safe to resend if the
+# connection drops before their response arrives.
+READ_COMMANDS = frozenset([
+    "INFO", "ENGINEERS_DATA", "GET_ZONES", "READ_DCB", "FIRMWARE",
+    "GET_TEMPLOG", "GET_GROUPS", "STATISTICS", "READ_COMFORT_LEVELS",
+])
+
+# Seconds to wait for the response to each command. The big dumps take
+# the hub a while to produce; everything else should be quick.
+DEFAULT_TIMEOUT = 10
+COMMAND_TIMEOUTS = {
+    "INFO": 8,
+    "ENGINEERS_DATA": 8,
+    "GET_ZONES": 5,
+    "READ_DCB": 5,
+    "FIRMWARE": 5,
+    "GET_GROUPS": 5,
+    "GET_TEMPLOG": 30,
+    "READ_COMFORT_LEVELS": 15,
+}
+
+# Which query family, and which fields of it, a write changes on each
+# device it addresses. "*" means we don't know the exact field names, so
+# treat the whole device as stale within that family.
+WRITE_FIELDS = {
+    "SET_TEMP":      ("INFO", ("CURRENT_SET_TEMPERATURE",)),
+    "SET_COOL_TEMP": ("INFO", ("*",)),
+    "FROST_ON":      ("INFO", ("STANDBY",)),
+    "FROST_OFF":     ("INFO", ("STANDBY",)),
+    "AWAY_ON":       ("INFO", ("AWAY",)),
+    "AWAY_OFF":      ("INFO", ("AWAY",)),
+    "BOOST_ON":      ("INFO", ("*",)),
+    "BOOST_OFF":     ("INFO", ("*",)),
+    "TIMER_ON":      ("INFO", ("TIMER", "TIME_CLOCK_OVERIDE_BIT")),
+    "TIMER_OFF":     ("INFO", ("TIMER", "TIME_CLOCK_OVERIDE_BIT")),
+    "LOCK":          ("INFO", ("LOCK",)),
+    "UNLOCK":        ("INFO", ("LOCK",)),
+    "SET_FROST":     ("ENGINEERS_DATA", ("FROST TEMPERATURE",)),
+    "SET_DIFF":      ("ENGINEERS_DATA", ("SWITCHING DIFFERENTIAL",)),
+    "SET_PREHEAT":   ("ENGINEERS_DATA", ("MAX PREHEAT",)),
+}
+
+
 class NeoHub(object):
 
-    def __init__(self, host, port, cache_duration=15):
+    def __init__(self, host, port, cache_duration=15, coalesce_window=0.05,
+                 engineers_cache_duration=300, confirm_after=5,
+                 min_backoff=0.1, max_backoff=30, timeouts=None,
+                 max_inflight=4, rate_limit=None, rate_burst=None, byte_rate_limit=None,
+                 dual_connection=False, health_interval=60, dual_retry=300,
+                 snapshot_path=None, address_by_id=False, groups_cache_duration=300,
+                 min_cache_duration=None, max_cache_duration=None):
         self._cache_duration = cache_duration or 15
+        # INFO carries the live fields (temperatures, heating bits) and is
+        # polled every cache_duration. ENGINEERS_DATA is mostly settings that
+        # rarely change, so gets its own, slower, cadence.
+        self._refresh_intervals = {
+            "INFO": self._cache_duration,
+            "ENGINEERS_DATA": engineers_cache_duration or self._cache_duration,
+        }
+        # With max_cache_duration, INFO's interval adapts instead: down to
+        # min_cache_duration while things are changing or after a write, up
+        # to max_cache_duration while the house is idle.
+        self._poll = None
+        if max_cache_duration:
+            self._poll = AdaptiveInterval(min_cache_duration or self._cache_duration, max_cache_duration)
+            self._refresh_intervals["INFO"] = self._poll.interval
         self._host = host
         self._port = port
-        self._sock = None
-        self.devices = {}
+        self._control = ConnectionSupervisor(host, port, min_backoff, max_backoff)
+        self._timeouts = dict(COMMAND_TIMEOUTS)
+        self._timeouts.update(timeouts or {})
+        self._scheduler = CommandScheduler(max_inflight, rate_limit, rate_burst, byte_rate_limit)
+        self._bulk = None
+        self._bulk_ok = False
+        self._bulk_failed_at = 0
+        self._health_task = None
+        self._health_interval = health_interval
+        self._dual_retry = dual_retry
+        if dual_connection:
+            self._bulk = ConnectionSupervisor(host, port, min_backoff, max_backoff)
+            self._bulk_scheduler = CommandScheduler(max_inflight, share=self._scheduler)
+        self.frame_sizes = {}
+        # device name -> dict-like row of fields, stored column-wise
+        self.devices = StateTable()
+        # names <-> zone ids <-> groups
+        self.index = ZoneIndex()
+        self._address_by_id = address_by_id
+        self._groups_cache_duration = groups_cache_duration
+        self._groups_loaded_at = 0
+        self._zones = {}
+        # zone name -> comfort level profile, as last read or set
+        self.comfort_levels = {}
+        self._dcb = None
+        self._snapshot_path = snapshot_path
+        self._revalidate_task = None
         self._neostats = {}
         self._neoplugs = {}
         self._connected = False
-        self._last_update_time = 0
-        self._dirty = False
+        self._last_refresh = {"INFO": 0, "ENGINEERS_DATA": 0}
+        # (device, field) -> (query, time after which a refresh should
+        # confirm the optimistic value poked in after a write)
+        self._stale = {}
+        self._confirm_after = confirm_after
         self._update_in_progress = False
+        self._update_task = None
+        self._confirm_task = None
+        self._writes = WriteCoalescer(self.call, coalesce_window)
+        self.changes = ChangeFeed()
+        self.metrics = Metrics()
 
     async def async_setup(self):
-        await self.connect_to_hub()
-        await self.initial_zone_load()
-        await self.read_dcb()
-        await self.update()
+        # Warm start: with a snapshot from a previous run, build the devices
+        # from it straight away, and bring everything up to date in the
+        # background.
+        if self._snapshot_path and self.load_snapshot():
+            self._revalidate_task = asyncio.ensure_future(self._revalidate())
+            return
+        await self._revalidate()
+
+    async def _revalidate(self):
+        try:
+            await self.connect_to_hub()
+            # GET_ZONES and READ_DCB don't depend on each other
+            await asyncio.gather(self.initial_zone_load(), self.read_dcb())
+            await self.update(force_update=True)
+        except Exception:
+            if self._revalidate_task is None:
+                raise
+            logging.exception("Failed to revalidate NeoHub state from snapshot")
+            return
+        finally:
+            self._revalidate_task = None
+        self.save_snapshot()
+
+    def load_snapshot(self):
+        """Loads zones, DCB and device state from snapshot_path. Returns
+        False if there's no usable snapshot."""
+        data = load_snapshot(self._snapshot_path, self._host, self._port)
+        if data is None:
+            return False
+        self._dcb = data["dcb"]
+        self._apply_zones(data["zones"])
+        for name, fields in data["devices"].items():
+            if name in self.devices:
+                self.devices[name].update(fields)
+                self._add_device(name, self.devices[name])
+        logging.debug("Loaded %d devices from snapshot %s", len(self.devices), self._snapshot_path)
+        return True
+
+    def save_snapshot(self):
+        if not self._snapshot_path:
+            return
+        try:
+            save_snapshot(self._snapshot_path, self._host, self._port,
+                          self._zones, self._dcb, self.devices.to_dict())
+        except OSError as e:
+            logging.warning("Could not save NeoHub snapshot %s: %s", self._snapshot_path, e)
 
     async def connect_to_hub(self):
-        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        conn = await self._control.connection()
+        if self._bulk is not None:
+            await self._open_bulk()
+            if self._health_task is None:
+                self._health_task = asyncio.ensure_future(self._health_loop())
+        return conn
+
+    def close(self):
+        if self._revalidate_task is not None:
+            self._revalidate_task.cancel()
+        elif self.devices:
+            self.save_snapshot()
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._confirm_task is not None:
+            self._confirm_task.cancel()
+        self._control.close()
+        if self._bulk is not None:
+            self._bulk.close()
+
+    @property
+    def reconnects(self):
+        return self._control.reconnects + (self._bulk.reconnects if self._bulk is not None else 0)
+
+    # With dual_connection, reads go over a second connection to the hub so
+    # that commands on the first never wait behind a big INFO/ENGINEERS_DATA
+    # or GET_TEMPLOG response. If the hub won't take a second connection, or
+    # it fails a health check, everything goes over the first until a retry
+    # after dual_retry seconds succeeds.
+    def _route(self, priority):
+        if priority != PRIORITY_WRITE and self._bulk_ok:
+            return self._bulk, self._bulk_scheduler
+        return self._control, self._scheduler
+
+    async def _open_bulk(self):
+        try:
+            await self._probe(self._bulk)
+        except (NeoHubError, ValueError, asyncio.TimeoutError) as e:
+            # ValueError: the probe's answer wasn't JSON
+            logging.warning("NeoHub refused a second connection, using one: %s", e)
+            self._bulk.close()
+            self._bulk_ok = False
+            self._bulk_failed_at = time.time()
+        else:
+            self._bulk_ok = True
+
+    async def _probe(self, supervisor):
+        conn = await supervisor.connection()
+        response, size = await conn.request(encode_frame({"FIRMWARE": 0}), self._timeouts["FIRMWARE"])
+        json.loads(response)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self._health_interval)
+            if self._bulk_ok:
+                try:
+                    await self._probe(self._bulk)
+                except (NeoHubError, ValueError, asyncio.TimeoutError) as e:
+                    logging.warning("Second NeoHub connection failed health check: %s", e)
+                    self._bulk.close()
+                    self._bulk_ok = False
+                    self._bulk_failed_at = time.time()
+            elif time.time() - self._bulk_failed_at >= self._dual_retry:
+                await self._open_bulk()
 
     async def read_dcb(self):
         """Reads neohub settings"""
         self._dcb = await self.call({"READ_DCB": 100})
 
     async def initial_zone_load(self):
-        self.devices = {}
-        zones = await self.get_zones()
+        self._apply_zones(await self.get_zones())
+
+    def _apply_zones(self, zones):
+        # a zone with the same id under a new name was renamed, maybe by
+        # someone else: carry its state over
+        for old, new in self.index.renamed_zones(zones):
+            self._rename_device(old, new)
+        # keep what we already know about zones that are still there
+        for name in self.devices.names():
+            if name not in zones:
+                self.devices.remove_row(name)
+                self._neostats.pop(name, None)
+                self._neoplugs.pop(name, None)
         for name in zones:
-            self.devices[name] = {"id": zones[name]}
-
+            self.devices.add_row(name)
+            self.devices.set(name, "id", zones[name])
+        self._zones = zones
+        self.index.update_zones(zones)
+
+    def _rename_device(self, old, new):
+        if old in self.devices and new not in self.devices:
+            self.devices.rename_row(old, new)
+        for devices in (self._neostats, self._neoplugs):
+            if old in devices:
+                device = devices[new] = devices.pop(old)
+                device.name = new
+        if old in self.comfort_levels:
+            self.comfort_levels[new] = self.comfort_levels.pop(old)
+        for (name, field), entry in list(self._stale.items()):
+            if name == old:
+                self._stale[(new, field)] = self._stale.pop((name, field))
+        self.index.rename(old, new)
+
+    def find_device(self, key):
+        """The NeoStat or NeoPlug for a zone name, in any case or accents,
+        or zone id. None if there isn't one."""
+        name = self.index.name(key)
+        return self._neostats.get(name) or self._neoplugs.get(name)
+
+    # Safe to call concurrently: requests are pipelined over the one
+    # connection and responses matched back up in FIFO order.
+    #
+    # If the connection drops, read commands are resent once over a fresh
+    # connection. Writes raise NeoHubConnectionError, since we can't tell
+    # whether the hub acted on them.
+    #
+    # Each command has a deadline (see COMMAND_TIMEOUTS); if the hub hasn't
+    # answered by then, NeoHubTimeout is raised.
+    #
+    # Commands are released to the hub by the scheduler: writes first, then
+    # live reads, then bulk reads, within max_inflight and the rate limits.
     async def call(self, j, expecting=None):
-        payload = bytearray(json.dumps(j) + "\0\r", "utf-8")
-        self._writer.write(payload)
-        await self._writer.drain()
-
-        response = ""
+        cmd = next(iter(j))
+        payload = encode_frame(j)
+        timeout = self._timeouts.get(cmd, DEFAULT_TIMEOUT)
+        priority = command_priority(cmd)
+        retried = False
         while True:
-            buf = (await self._reader.read(4096)).decode()
-            response += buf
-            if "\0" in response:
-                response = response.rstrip("\0")
-                break
-            if len(response) == 0:
+            supervisor, scheduler = self._route(priority)
+            try:
+                async with scheduler.slot(priority) as slot:
+                    try:
+                        conn = await supervisor.connection()
+                    except NeoHubConnectionError:
+                        if supervisor is not self._bulk:
+                            raise
+                        # can't get the second connection back; fall back
+                        # to the first rather than fail the read
+                        self._bulk_ok = False
+                        self._bulk_failed_at = time.time()
+                        continue
+                    start = time.monotonic()
+                    response, size = await conn.request(payload, timeout)
+                    slot.nbytes = len(payload) + size
+                    self.metrics.command(cmd, time.monotonic() - start, len(payload), size)
                 break
-
-        self._dirty = True
+            except asyncio.TimeoutError:
+                self.metrics.error(cmd, "timeout")
+                raise NeoHubTimeout("No response from NeoHub to %s within %ss" % (cmd, timeout))
+            except NeoHubConnectionError as e:
+                self.metrics.error(cmd, "connection")
+                if cmd not in READ_COMMANDS or retried:
+                    raise NeoHubConnectionError("Lost connection to NeoHub during %s: %s" % (cmd, e)) from e
+                logging.info("Lost connection to NeoHub during %s, retrying", cmd)
+                retried = True
+        self.frame_sizes[cmd] = size
 
         # Got string back from hub, now decode json
-        jobj = json.loads(response)
+        try:
+            jobj = json.loads(response)
+        except ValueError:
+            # garbage, or a frame glued to a partial one: either way we can
+            # no longer trust which response belongs to which request
+            conn.close()
+            self.metrics.error(cmd, "malformed")
+            raise NeoHubError("Malformed response from NeoHub to %s: %r" % (cmd, response[:200]))
         # if no expected response, parse as JSON and return
         if expecting is None:
             return jobj
@@ -70,9 +357,100 @@ class NeoHub(object):
             if json_compare(jobj, expecting):
                 return True
             else:
+                self.metrics.unexpected[cmd] += 1
                 logging.warning("Unexpected response from '%s'\nExpected: %s\nReceived: %s", json.dumps(j), repr(expecting), response)
                 return
 
+    # Device commands go through the coalescer, which merges writes made
+    # within coalesce_window into array commands. coalesce_window=0 sends
+    # each one straight away.
+    #
+    # Devices can be given as zone names (in any case or accents), zone ids
+    # or group names. With address_by_id, zones are sent as their ids,
+    # which keeps commands to many zones short.
+    async def _write(self, q, expecting=None):
+        (cmd, arg), = q.items()
+        has_value = COALESCABLE[cmd][1]
+        # [value, device(s)] or just device(s)
+        device = self.index.resolve(arg[1] if has_value else arg)
+        target = self.index.to_ids(device) if self._address_by_id else device
+        q = {cmd: [arg[0], target] if has_value else target}
+        try:
+            return await self._writes.write(q, expecting=expecting)
+        finally:
+            self._mark_stale(cmd, device)
+            if self._poll is not None:
+                self._poll.reset()
+                self._refresh_intervals["INFO"] = self._poll.interval
+
+    # Writes only invalidate the fields they touch, on the devices they
+    # address. Plain reads (GET_TEMPLOG, FIRMWARE etc) leave the cache alone.
+    def _mark_stale(self, cmd, device):
+        if cmd not in WRITE_FIELDS:
+            return
+        query, fields = WRITE_FIELDS[cmd]
+        names = self.index.expand(device)
+        if names is None:
+            # a group we haven't loaded, or something the hub knows and we
+            # don't: assume everything
+            names = list(self.devices)
+        confirm_at = time.time() + self._confirm_after
+        for name in names:
+            for field in fields:
+                self._stale[(name, field)] = (query, confirm_at)
+
+    def is_stale(self, name, field):
+        """True if field was written and its value not yet confirmed by a
+        refresh. Stale data past its confirmation time schedules one."""
+        if not self._stale:
+            return False
+        entry = self._stale.get((name, field)) or self._stale.get((name, "*"))
+        if entry is None:
+            return False
+        if entry[1] <= time.time() and self._update_task is None and self._confirm_task is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # not called from the hub's loop; the next update() confirms it
+                return True
+            self._confirm_task = loop.create_task(self.update())
+            self._confirm_task.add_done_callback(self._confirm_done)
+        return True
+
+    def _confirm_done(self, task):
+        self._confirm_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("NeoHub refresh to confirm written values failed: %r", task.exception())
+
+    def frame_stats(self):
+        """Response frame sizes: totals for the connection, and the size of
+        the latest response to each command"""
+        stats = self._control.conn.framer.stats() if self._control.conn else {}
+        if self._bulk_ok and self._bulk.conn:
+            stats["bulk"] = self._bulk.conn.framer.stats()
+        stats["by_command"] = dict(self.frame_sizes)
+        return stats
+
+    def _gauges(self):
+        return {
+            "connected": self._control.conn is not None and self._control.conn.connected,
+            "reconnects_total": self.reconnects,
+            "devices": len(self.devices),
+            "stale_fields": len(self._stale),
+            "poll_interval_seconds": self._refresh_intervals["INFO"],
+            "queued_commands": self._scheduler.waiting() + (self._bulk_scheduler.waiting() if self._bulk else 0),
+        }
+
+    def metrics_snapshot(self):
+        """Traffic counters and histograms (see Metrics), plus connection
+        state, as a dict"""
+        return self.metrics.snapshot(self._gauges())
+
+    def metrics_text(self, prefix="neohub"):
+        """The same, in Prometheus text format, labelled with the hub
+        address"""
+        return self.metrics.prometheus(prefix, {"hub": "%s:%s" % (self._host, self._port)}, self._gauges())
+
     def neostats(self):
         return self._neostats
 
@@ -91,6 +469,16 @@ class NeoHub(object):
     ##          or a list of device names, eg: ["Kitchen", "Bedroom 2"]
     ##          or a group name, eg: "First Floor"
 
+    def subscribe(self, callback):
+        """Calls callback(changes), a list of Change(device, field, old, new),
+        after each refresh that changed anything. Returns an unsubscribe
+        function."""
+        return self.changes.subscribe(callback)
+
+    def watch(self, maxsize=1024):
+        """async for change in hub.watch(): ..."""
+        return self.changes.watch(maxsize)
+
     async def set_away_mode(self, device, onoff):
         if onoff:
             return await self.set_away_mode_on(device)
@@ -106,7 +494,7 @@ class NeoHub(object):
     # array of valid devices"}
     async def set_unlocked(self, device):
         q = {"UNLOCK": device}
-        return await self.call(q, expecting={"result": "unlocked"})
+        return await self._write(q, expecting={"result": "unlocked"})
 
     # LOCK
     # {"LOCK":[[<pin1>,<pin2>,<pin3>,<pin4>], <device(s)>]}
@@ -124,7 +512,7 @@ class NeoHub(object):
         # split 4 digits of string pin into list of ints
         pin = list(map(int, pin_str))
         q = {"LOCK": [pin, device]}
-        return await self.call(q, expecting={"result": "locked"})
+        return await self._write(q, expecting={"result": "locked"})
 
     # AWAY_ON
     # Possible results
@@ -134,7 +522,7 @@ class NeoHub(object):
     #           array of valid devices"}
     async def set_away_mode_on(self, device):
         q = {"AWAY_ON": device}
-        return await self.call(q, expecting={"result": "away on"})
+        return await self._write(q, expecting={"result": "away on"})
 
     # AWAY_OFF
     # Possible results
@@ -144,7 +532,7 @@ class NeoHub(object):
     #           array of valid devices"}
     async def set_away_mode_off(self, device):
         q = {"AWAY_OFF": device}
-        return await self.call(q, expecting={"result": "away off"})
+        return await self._write(q, expecting={"result": "away off"})
 
     # SET_FORMAT
     # {"SET_FORMAT":<format>}
@@ -160,6 +548,82 @@ class NeoHub(object):
         q = {"SET_FORMAT": mode}
         return await self.call(q, expecting={"result": "Format was set"})
 
+    # READ_COMFORT_LEVELS
+    # {"READ_COMFORT_LEVELS":<device(s)>}
+    # Possible results
+    # {<device>:{<day>:{<level>:[<time>,<temperature>], etc}, etc}, etc}
+    # where the days depend on the program mode, eg "monday".."sunday"
+    async def read_comfort_levels(self, device):
+        """{zone: profile} for device(s); see neohub.schedule"""
+        names = self.index.resolve(device if isinstance(device, list) else [device])
+        resp = await self.call({"READ_COMFORT_LEVELS": names})
+        if "error" in resp:
+            raise NeoHubError("Couldn't read comfort levels for %s: %s" % (names, resp["error"]))
+        levels = {}
+        for name, profile in resp.items():
+            levels[name] = self.comfort_levels[name] = normalize_profile(profile)
+        return levels
+
+    # SET_COMFORT_LEVELS
+    # {"SET_COMFORT_LEVELS":[<comfort levels>, <device(s)>]}
+    # with comfort levels as returned by READ_COMFORT_LEVELS for one device.
+    # Possible results (assumed, by analogy with the other set commands)
+    # {"result":"comfort levels set"}
+    async def set_comfort_levels(self, device, levels):
+        levels = normalize_profile(levels)
+        device = self.index.resolve(device)
+        q = {"SET_COMFORT_LEVELS": [levels, device]}
+        result = await self.call(q, expecting={"result": "comfort levels set"})
+        if result:
+            for name in self.index.expand(device) or ():
+                self.comfort_levels.setdefault(name, {}).update(levels)
+        return result
+
+    async def sync_comfort_levels(self, desired, partial_days=False, dry_run=False):
+        """Brings zones' programs to desired, {zone: profile}, sending as
+        little as possible.
+
+        Keys can be zone names or ids, group names, or "*" for every
+        NeoStat. Days are merged: a zone's own days beat its group's, which
+        beat those for "*". The zones' current programs are read in one
+        command, zones already as desired are skipped, and zones needing the
+        same change share one SET_COMFORT_LEVELS. With partial_days, only
+        the days that differ are sent (if the hub takes partial programs).
+
+        Returns the changes, [(profile, [zones])]; with dry_run, without
+        making them.
+        """
+        if not self.index.groups_loaded and any(key != "*" and key not in self.index for key in desired):
+            await self.get_groups()
+
+        def specificity(key):
+            return 0 if key == "*" else 2 if key in self.index else 1
+
+        targets = {}
+        for key in sorted(desired, key=specificity):
+            if key == "*":
+                names = set(self._neostats)
+            else:
+                names = self.index.expand(self.index.resolve(key))
+                if names is None:
+                    raise NeoHubScheduleError("No zone or group called %r" % (key,))
+            profile = normalize_profile(desired[key])
+            for name in names:
+                targets[name] = dict(targets.get(name, {}), **profile)
+        if not targets:
+            return []
+
+        current = await self.read_comfort_levels(sorted(targets))
+        plan = plan_changes(current, targets, partial_days)
+        if dry_run:
+            return plan
+        results = await asyncio.gather(*[self.set_comfort_levels(zones if len(zones) > 1 else zones[0], profile)
+                                         for profile, zones in plan])
+        failed = [zone for (profile, zones), result in zip(plan, results) if not result for zone in zones]
+        if failed:
+            raise NeoHubError("NeoHub didn't accept comfort levels for %s" % ", ".join(failed))
+        return plan
+
 
     # BOOST_OFF
     # {"BOOST_OFF":[{"hours":0,"minutes":10},<devices>]}
@@ -172,7 +636,7 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def boost_off(self, device, interval):
         q = {"BOOST_OFF": [interval, device]}
-        return await self.call(q, expecting={"result": "boost off"})
+        return await self._write(q, expecting={"result": "boost off"})
 
     # BOOST_ON
     # {"BOOST_OFF":[{"hours":0,"minutes":10},<devices>]]}
@@ -185,7 +649,7 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def boost_on(self, device, interval):
         q = {"BOOST_ON": [interval, device]}
-        return await self.call(q, expecting={"result": "boost on"})
+        return await self._write(q, expecting={"result": "boost on"})
 
     # FROST_OFF
     # {"FROST_OFF":<device(s)>}
@@ -196,7 +660,7 @@ class NeoHub(object):
     # array of valid devices"}
     async def frost_off(self, device):
         q = {"FROST_OFF": device}
-        return await self.call(q, expecting={"result": "frost off"})
+        return await self._write(q, expecting={"result": "frost off"})
 
     # FROST_ON
     # {"FROST_ON":<device(s)>}
@@ -207,7 +671,7 @@ class NeoHub(object):
     # array of valid devices"}
     async def frost_on(self, device):
         q = {"FROST_ON": device}
-        return await self.call(q, expecting={"result": "frost on"})
+        return await self._write(q, expecting={"result": "frost on"})
 
     # SET_FROST - aka set minimum temp
     # {"SET_FROST":[<temp>, <device(s)>]}
@@ -220,11 +684,11 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def set_frost(self, device, temp):
         q = {"SET_FROST": [int(temp), device]}
-        return await self.call(q, expecting={"result": "temperature was set"})
+        return await self._write(q, expecting={"result": "temperature was set"})
 
     async def set_diff(self, device, dtemp):
         q = {"SET_DIFF":[int(dtemp), device]}
-        return await self.call(q, expecting={"result": "switching differential was set"})
+        return await self._write(q, expecting={"result": "switching differential was set"})
 
     # SET_PREHEAT
     # {"SET_PREHEAT":[<temp>, <device(s)>]}
@@ -237,7 +701,7 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def set_preheat(self, device, temp):
         q = {"SET_PREHEAT": [int(temp), device]}
-        return await self.call(q, expecting={"result": "max preheat was set"})
+        return await self._write(q, expecting={"result": "max preheat was set"})
 
     # SET_TEMP
     # {"SET_TEMP":[<temp>, <device(s)>]}
@@ -251,7 +715,7 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def set_temp(self, device, temp):
         q = {"SET_TEMP": [int(temp), device]}
-        return await self.call(q, expecting={"result": "temperature was set"})
+        return await self._write(q, expecting={"result": "temperature was set"})
 
     # SET_COOL_TEMP
     # {"SET_COOL_TEMP":[<temp>, <device(s)>]}
@@ -266,7 +730,7 @@ class NeoHub(object):
     # device or array of valid devices"}
     async def set_cool_temp(self, device, temp):
         q = {"SET_COOL_TEMP": [int(temp), device]}
-        return await self.call(q, expecting={"result": "temperature was set"})
+        return await self._write(q, expecting={"result": "temperature was set"})
 
     # CREATE_GROUP
     # {"CREATE_GROUP":[[<devices>], <name>]}
@@ -280,8 +744,12 @@ class NeoHub(object):
     # {"error":"second argument to CREATE_GROUP should be a string (group
     # name)"}
     async def create_group(self, device, name):
-        q = {"CREATE_GROUP": [[device], str(name)]}
-        return await self.call(q, expecting={"result": "group created"})
+        devices = self.index.resolve(device if isinstance(device, list) else [device])
+        q = {"CREATE_GROUP": [devices, str(name)]}
+        result = await self.call(q, expecting={"result": "group created"})
+        if result:
+            self.index.add_group(str(name), devices)
+        return result
 
     # DELETE_GROUP
     # {"DELETE_GROUP":<group>}
@@ -296,8 +764,21 @@ class NeoHub(object):
     # {"<groupname1>":["<devicename1>", "<devicename2>", <etc>],
     # "<groupname2>":[<members>], <etc>}
     async def delete_group(self, name):
-        q = {"DELETE_GROUP": str(name)}
-        return await self.call(q, expecting={"result": "group removed"})
+        q = {"DELETE_GROUP": str(self.index.group(name) or name)}
+        result = await self.call(q, expecting={"result": "group removed"})
+        if result:
+            self.index.remove_group(q["DELETE_GROUP"])
+        return result
+
+    async def get_groups(self, refresh=False):
+        """{group: frozenset of member names}. Fetched from the hub at most
+        every groups_cache_duration seconds, unless refresh; create_group()
+        and delete_group() keep the copy up to date in between."""
+        if refresh or not self.index.groups_loaded or \
+                time.time() - self._groups_loaded_at >= self._groups_cache_duration:
+            self.index.update_groups(await self.call({"GET_GROUPS": 0}))
+            self._groups_loaded_at = time.time()
+        return self.index.groups()
 
     # ZONE_TITLE
     # {"ZONE_TITLE":[<oldname>, <newname>]}
@@ -309,8 +790,12 @@ class NeoHub(object):
     # {"error":"second argument to ZONE_TITLE should be a string (new
     # device name)"}
     async def zone_title(self, oldname, newname):
+        oldname = self.index.name(oldname) or oldname
         q = {"ZONE_TITLE": [str(oldname), str(newname)]}
-        return await self.call(q, expecting={"result": "zone renamed"})
+        result = await self.call(q, expecting={"result": "zone renamed"})
+        if result:
+            self._rename_device(str(oldname), str(newname))
+        return result
 
     async def firmware_version(self):
         q = {"FIRMWARE": 0}
@@ -326,7 +811,7 @@ class NeoHub(object):
     # {"error":"Invalid argument to GET_TEMPLOG, should be a valid device
     # or array of valid devices"}
     async def get_templog(self, device):
-        q = {"GET_TEMPLOG": device}
+        q = {"GET_TEMPLOG": self.index.resolve(device)}
         return await self.call(q)
 
     # GET_ZONES
@@ -375,65 +860,154 @@ class NeoHub(object):
     # or array of valid devices"}
     async def switch_plug_on(self, device):
         q = {"TIMER_ON": device}
-        return await self.call(q, expecting={"result": "time clock overide on"})
+        return await self._write(q, expecting={"result": "time clock overide on"})
 
     async def switch_plug_off(self, device):
         q = {"TIMER_OFF": device}
-        return await self.call(q, expecting={"result": "timers off"})
+        return await self._write(q, expecting={"result": "timers off"})
 
     # Guard / memoize / debounce access to actual_update()
+    # Single flight: callers arriving while a refresh is running all await
+    # that same refresh, and get its result (or its exception).
+    #
+    # metrics counts an update() served without a refresh of its own (from
+    # cache, or by joining one already running) as a cache hit.
+    #
+    # force_update=True refreshes everything; a list of queries, eg
+    # ["INFO"], refreshes just those now, and the rest if they're due.
     async def update(self, force_update=False):
-        if self._update_in_progress:
-            return self.devices
-
-        if (self._dirty or self._last_update_time is None or force_update or (time.time() - self._last_update_time) >= self._cache_duration):
-            self._last_update_time = time.time()
-            logging.debug("Querying NeoHub for all device data")
-            self._dirty = False
-            return await self.actual_update()
+        if self._update_task is not None:
+            self.metrics.cache_hits += 1
+            return await asyncio.shield(self._update_task)
+
+        queries = self._due_queries(force_update)
+        if queries:
+            self.metrics.cache_misses += 1
+            now = time.time()
+            for q in queries:
+                self._last_refresh[q] = now
+            logging.debug("Querying NeoHub for %s", ", ".join(queries))
+            self._update_task = asyncio.ensure_future(self.actual_update(queries))
+            self._update_task.add_done_callback(functools.partial(self._update_done, queries))
+            return await asyncio.shield(self._update_task)
         else:
-            #logging.debug("(cached)")
+            self.metrics.cache_hits += 1
             return self.devices
 
+    def _due_queries(self, force):
+        now = time.time()
+        # stale fields whose confirmation time has passed make their
+        # query due, even if its cadence hasn't come round yet
+        confirm = set(query for query, confirm_at in self._stale.values() if confirm_at <= now)
+        if force is True:
+            force = self._refresh_intervals
+        return [q for q, interval in self._refresh_intervals.items()
+                if (force and q in force) or q in confirm or now - self._last_refresh[q] >= interval]
+
+    def _update_done(self, queries, task):
+        self._update_task = None
+        if task.cancelled() or task.exception() is not None:
+            # don't serve the old data as fresh; retry on the next update()
+            for q in queries:
+                self._last_refresh[q] = 0
+            return
+        # a refresh confirms anything written before it was due for
+        # confirmation
+        for key, (query, confirm_at) in list(self._stale.items()):
+            if query in queries and confirm_at <= self._last_refresh[query]:
+                del self._stale[key]
+
     # Merge together INFO and ENGINEERS_DATA for each device
     # and augment with some derived field names, in lower-case
     # since various things are inconsistently named
-    async def actual_update(self):
+    #
+    # queries picks which of INFO / ENGINEERS_DATA to refresh (default both);
+    # fields from each are merged into the existing device dicts, so values
+    # from a query that wasn't re-run are kept.
+    async def actual_update(self, queries=None):
         self._update_in_progress = True
-        resp = await self.call({"INFO": 0})
-        resp2 = await self.call({"ENGINEERS_DATA": 0})
-        for dev in resp["devices"]:
-            name = dev["device"]
-            merged = dev.copy()
-            merged.update(resp2[name])
-            self.devices[name].update(merged)
-
-            # device type 1, 12 = neostat
-            #             6     = neoplug
-            if merged["DEVICE_TYPE"] == 0:
-                # offline therm?
-                pass
-            elif merged["DEVICE_TYPE"] in [1, 11, 12]:
-                if name not in self._neostats:
-                    self._neostats[name] = NeoStat(self, name)
-            elif merged["DEVICE_TYPE"] == 6:
-                if name not in self._neoplugs:
-                    self._neoplugs[name] = NeoPlug(self, name)
-            else:
-                logging.warn("Unimplemented NeoSomething device_type(%s)! "
-                             "Only support neostat(1), neostat(11) and neoplug(6) at the mo" % (merged["DEVICE_TYPE"]))
-                print(repr(merged))
-                pass
-
-        self._update_in_progress = False
+        start = time.monotonic()
+        try:
+            result = await self._merge_update(queries or list(self._refresh_intervals))
+            self.metrics.refresh_duration.observe(time.monotonic() - start)
+            return result
+        finally:
+            self._update_in_progress = False
+
+    async def _merge_update(self, queries):
+        results = await asyncio.gather(*[self.call({q: 0}) for q in queries])
+        resp = dict(zip(queries, results))
+
+        # only collect changes if someone is listening for them, or they
+        # set the polling interval
+        changes = [] if self.changes or self._poll is not None else None
+        updated = []
+        if "INFO" in resp:
+            if any(dev["device"] not in self.devices for dev in resp["INFO"]["devices"]):
+                # a zone added or renamed since GET_ZONES
+                self._apply_zones(await self.get_zones())
+            for dev in resp["INFO"]["devices"]:
+                name = dev["device"]
+                self.devices.add_row(name)
+                self.devices.update_row(name, dev, changes)
+                updated.append(name)
+        if "ENGINEERS_DATA" in resp:
+            for name, fields in resp["ENGINEERS_DATA"].items():
+                if name in self.devices:
+                    self.devices.update_row(name, fields, changes)
+                    if "INFO" not in resp:
+                        updated.append(name)
+
+        for name in updated:
+            self._add_device(name, self.devices[name])
+
+        if self._poll is not None and "INFO" in resp:
+            self._refresh_intervals["INFO"] = self._poll.observe(changes)
+        if changes:
+            self.changes.publish(changes)
         return self.devices
 
+    def _add_device(self, name, merged):
+        # device type 1, 12 = neostat
+        #             6     = neoplug
+        if merged.get("DEVICE_TYPE") is None:
+            # not seen ENGINEERS_DATA for it yet
+            pass
+        elif merged["DEVICE_TYPE"] == 0:
+            # offline therm?
+            pass
+        elif merged["DEVICE_TYPE"] in [1, 11, 12]:
+            if name not in self._neostats:
+                self._neostats[name] = NeoStat(self, name)
+        elif merged["DEVICE_TYPE"] == 6:
+            if name not in self._neoplugs:
+                self._neoplugs[name] = NeoPlug(self, name)
+        else:
+            logging.warn("Unimplemented NeoSomething device_type(%s)! "
+                         "Only support neostat(1), neostat(11) and neoplug(6) at the mo" % (merged["DEVICE_TYPE"]))
+            print(repr(merged))
+            pass
+
     def devices(self):
         return self.devices
 
     def device(self, name):
         return self.devices[name]
 
+    def zones_below_set_temperature(self):
+        """Names of devices currently colder than their set temperature"""
+        return self.devices.below("CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE")
+
+    def count_heating(self):
+        return self.devices.count("HEATING")
+
+    def max_temperature_by_group(self, groups=None):
+        """groups is {group name: [device names]}, by default the hub's
+        groups as last loaded by get_groups()"""
+        if groups is None:
+            groups = self.index.groups()
+        return self.devices.max_by_group("CURRENT_TEMPERATURE", groups)
+
 
 def json_compare(j1, j2):
     return ordered(j1) == ordered(j2)
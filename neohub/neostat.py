@@ -90,6 +90,19 @@ class NeoStat(NeoDevice):
     async def set_locked(self, pin_str):
         return await self.hub.set_unlocked(self.name, pin_str)
 
+    def comfort_levels(self):
+        """The weekly program, {day: {level: [time, temperature]}}, as last
+        read or set; None if neither has happened yet"""
+        return self.hub.comfort_levels.get(self.name)
+
+    async def read_comfort_levels(self):
+        """Reads the weekly program from the hub"""
+        return (await self.hub.read_comfort_levels(self.name)).get(self.name)
+
+    async def set_comfort_levels(self, levels):
+        """Sets the weekly program (or some days of it)"""
+        return await self.hub.set_comfort_levels(self.name, levels)
+
     async def set_set_temperature(self, temp):
         """Sets the so-called SET_TEMPERATURE
 
@@ -0,0 +1,49 @@
+"""How often to poll INFO, going by how much the house is changing.
+
+While zones are heating, timers switching or temperatures moving, INFO is
+polled every min_interval; after each refresh that finds nothing of the
+sort the interval grows by factor, up to max_interval. A write drops it
+straight back to min_interval, to see its effects promptly.
+"""
+
+# INFO fields whose changes mean something is going on
+ACTIVITY_FIELDS = frozenset(["HEATING", "TIMER", "CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE"])
+TEMPERATURE_FIELDS = frozenset(["CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE"])
+
+
+def is_activity(change, temperature_threshold=0.2):
+    """True if change (a Change) is a sign of activity, rather than noise:
+    any change to the heating or timer bits, and temperature moves of at
+    least temperature_threshold degrees"""
+    if change.field not in ACTIVITY_FIELDS:
+        return False
+    if change.field in TEMPERATURE_FIELDS and change.old is not None:
+        try:
+            return abs(float(change.new) - float(change.old)) >= temperature_threshold
+        except (TypeError, ValueError):
+            pass
+    return True
+
+
+class AdaptiveInterval(object):
+    """A polling interval between min_interval and max_interval, that
+    backs off exponentially while nothing changes"""
+    def __init__(self, min_interval, max_interval, factor=2, temperature_threshold=0.2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.factor = factor
+        self.temperature_threshold = temperature_threshold
+        self.interval = min_interval
+
+    def observe(self, changes):
+        """Adjusts the interval after a refresh that found changes, a list
+        of Change. Returns the new interval."""
+        if any(is_activity(c, self.temperature_threshold) for c in changes):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        return self.interval
+
+    def reset(self):
+        """Back to the shortest interval, eg after a write"""
+        self.interval = self.min_interval
@@ -0,0 +1,217 @@
+"""A caching proxy, so several clients can share one connection to a hub.
+
+NeoHubProxy listens for the hub's legacy JSON-over-TCP protocol and
+forwards commands to the real hub over a single NeoHub connection (and so
+through its scheduler, rate limits and reconnects):
+
+- INFO, ENGINEERS_DATA and GET_ZONES are answered from a cache for ttl
+  seconds after each fetch.
+- Identical reads arriving while one is already on its way to the hub
+  share its response, rather than each being sent.
+- Writes are always forwarded, and drop the cached reads they affect.
+- If the hub can't be reached, cached reads are served however old they
+  are (up to max_stale seconds, if set); anything else gets an error
+  response, as a hub would give, rather than no response at all.
+
+    $ python -m neohub.proxy 192.168.0.123 --listen 127.0.0.1:4242
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+
+from .exceptions import NeoHubError
+from .framer import FrameSplitter
+from .neohub import NeoHub, READ_COMMANDS, WRITE_FIELDS
+
+
+CACHED_COMMANDS = frozenset(["INFO", "ENGINEERS_DATA", "GET_ZONES"])
+
+
+class _CacheEntry(object):
+    __slots__ = ("cmd", "response", "fetched", "valid")
+
+    def __init__(self, cmd, response):
+        self.cmd = cmd
+        self.response = response
+        self.fetched = time.monotonic()
+        self.valid = True
+
+
+class NeoHubProxy(object):
+    """Serves the legacy protocol on behalf of hub (a NeoHub).
+
+    stats counts, by outcome: "hit" (served from cache), "miss" (fetched),
+    "shared" (joined a read already in flight), "stale" (cached, served
+    because the hub failed), "write", and "error".
+    """
+    def __init__(self, hub, ttl=2, max_stale=None):
+        self.hub = hub
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.stats = collections.Counter()
+        self._cache = {}
+        self._inflight = {}
+        self._server = None
+        self._writers = set()
+
+    async def start(self, host="127.0.0.1", port=4242):
+        """Starts listening; port 0 picks a free port (see .port)"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        # Clients may pipeline commands, and expect the answers in the same
+        # order. Each command is answered concurrently; a sender task writes
+        # the answers out in the order the commands came in.
+        self._writers.add(writer)
+        answers = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(answers, writer))
+        splitter = FrameSplitter()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for text, size in splitter.feed(data):
+                    if text:
+                        answers.put_nowait(asyncio.ensure_future(self._answer(text)))
+        except ConnectionError:
+            pass
+        finally:
+            answers.put_nowait(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _send(self, answers, writer):
+        while True:
+            answer = await answers.get()
+            if answer is None:
+                return
+            writer.write(await answer)
+            await writer.drain()
+
+    async def _answer(self, text):
+        try:
+            j = json.loads(text)
+        except ValueError:
+            response = {"error": "Invalid JSON"}
+        else:
+            if isinstance(j, dict) and len(j) == 1:
+                response = await self.respond(j)
+            else:
+                response = {"error": "Invalid command"}
+        return (json.dumps(response) + "\0").encode("utf-8")
+
+    async def respond(self, j):
+        """The response to one command, from the cache or the hub"""
+        cmd = next(iter(j))
+        if cmd not in READ_COMMANDS:
+            return await self._write(cmd, j)
+
+        key = json.dumps(j, sort_keys=True)
+        entry = self._cache.get(key)
+        if entry is not None and entry.valid and time.monotonic() - entry.fetched < self.ttl:
+            self.stats["hit"] += 1
+            return entry.response
+
+        fetch = self._inflight.get(key)
+        if fetch is None:
+            self.stats["miss"] += 1
+            fetch = self._inflight[key] = asyncio.ensure_future(self._fetch(key, cmd, j))
+        else:
+            self.stats["shared"] += 1
+        try:
+            return await asyncio.shield(fetch)
+        except (NeoHubError, ConnectionError, asyncio.TimeoutError) as e:
+            entry = self._cache.get(key)
+            if entry is not None and (self.max_stale is None or time.monotonic() - entry.fetched < self.max_stale):
+                self.stats["stale"] += 1
+                logging.warning("NeoHub unavailable (%s), serving %s from %.0fs ago",
+                                e, cmd, time.monotonic() - entry.fetched)
+                return entry.response
+            self.stats["error"] += 1
+            return {"error": "NeoHub unavailable: %s" % e}
+
+    async def _fetch(self, key, cmd, j):
+        try:
+            response = await self.hub.call(j)
+            if cmd in CACHED_COMMANDS and not (isinstance(response, dict) and "error" in response):
+                self._cache[key] = _CacheEntry(cmd, response)
+            return response
+        finally:
+            del self._inflight[key]
+
+    async def _write(self, cmd, j):
+        self.stats["write"] += 1
+        try:
+            return await self.hub.call(j)
+        except (NeoHubError, ConnectionError, asyncio.TimeoutError) as e:
+            self.stats["error"] += 1
+            return {"error": "NeoHub unavailable: %s" % e}
+        finally:
+            # whether or not the hub acted on it, the cache can't be trusted
+            self.invalidate(WRITE_FIELDS[cmd][0] if cmd in WRITE_FIELDS else None)
+
+    def invalidate(self, cmd=None):
+        """Makes cached responses to cmd (default: all of them) be fetched
+        afresh. They're kept to serve if the hub goes down."""
+        for entry in self._cache.values():
+            if cmd is None or entry.cmd == cmd:
+                entry.valid = False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Caching proxy for a NeoHub's legacy JSON API")
+    parser.add_argument("hub", help="hub address, host[:port]")
+    parser.add_argument("--listen", default="127.0.0.1:4242", help="address to serve on (default 127.0.0.1:4242)")
+    parser.add_argument("--ttl", type=float, default=2, help="seconds to cache INFO/ENGINEERS_DATA/GET_ZONES")
+    parser.add_argument("--max-stale", type=float, default=None,
+                        help="oldest cached data to serve while the hub is down, seconds (default: any)")
+    parser.add_argument("--dual-connection", action="store_true", help="use a second hub connection for reads")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    host, _, port = args.hub.partition(":")
+    listen_host, _, listen_port = args.listen.rpartition(":")
+    hub = NeoHub(host, int(port or 4242), dual_connection=args.dual_connection)
+    proxy = NeoHubProxy(hub, ttl=args.ttl, max_stale=args.max_stale)
+
+    async def serve():
+        await proxy.start(listen_host or "127.0.0.1", int(listen_port))
+        logging.info("Proxying NeoHub %s on %s:%d", args.hub, listen_host, proxy.port)
+        await proxy.serve_forever()
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+        hub.close()
+
+
+if __name__ == "__main__":
+    main()
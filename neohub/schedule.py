@@ -0,0 +1,83 @@
+"""Comfort levels: the weekly heating programs of NeoStats.
+
+A profile is the hub's own layout, {day: {level: ["HH:MM", temperature]}},
+eg {"monday": {"wake": ["07:00", 21], "leave": ["09:00", 16], ...}, ...}.
+Which days appear depends on the hub's program mode (7 day, 5/2 day...);
+profiles are compared as they are, without interpreting the days.
+"""
+import json
+import re
+
+from .exceptions import NeoHubScheduleError
+
+
+_TIME = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def normalize_profile(profile):
+    """A copy of profile in one canonical form, so equal programs compare
+    equal: lower-case day and level names, "HH:MM" times, whole-number
+    temperatures as ints. Raises NeoHubScheduleError for anything malformed."""
+    if not isinstance(profile, dict):
+        raise NeoHubScheduleError("comfort levels should be {day: {level: [time, temperature]}}, not %r" % (profile,))
+    out = {}
+    for day, levels in profile.items():
+        if not isinstance(levels, dict):
+            raise NeoHubScheduleError("%s: levels should be {level: [time, temperature]}, not %r" % (day, levels))
+        out_levels = out[str(day).lower()] = {}
+        for level, setting in levels.items():
+            try:
+                time, temperature = setting
+            except (TypeError, ValueError):
+                raise NeoHubScheduleError("%s %s: should be [time, temperature], not %r" % (day, level, setting))
+            m = _TIME.match(str(time))
+            if not m:
+                raise NeoHubScheduleError("%s %s: bad time %r" % (day, level, time))
+            try:
+                temperature = float(temperature)
+            except (TypeError, ValueError):
+                raise NeoHubScheduleError("%s %s: bad temperature %r" % (day, level, temperature))
+            if temperature == int(temperature):
+                temperature = int(temperature)
+            out_levels[str(level).lower()] = ["%02d:%s" % (int(m.group(1)), m.group(2)), temperature]
+    return out
+
+
+def profile_key(profile):
+    """A hashable form of a (normalized) profile, for grouping"""
+    return json.dumps(profile, sort_keys=True)
+
+
+def diff_profile(current, desired, partial_days=False):
+    """What to send to bring the days in desired about: None if current
+    already has them. Otherwise the whole program, current with desired's
+    days laid over it, or with partial_days only the days that differ."""
+    current = normalize_profile(current or {})
+    desired = normalize_profile(desired)
+    changed = dict((day, levels) for day, levels in desired.items() if current.get(day) != levels)
+    if not changed:
+        return None
+    if partial_days:
+        return changed
+    return dict(current, **changed)
+
+
+def plan_changes(current, desired, partial_days=False):
+    """The SET_COMFORT_LEVELS commands needed to bring zones to their
+    desired profiles.
+
+    current and desired map zone name to profile. Zones already as desired
+    are left out; zones needing identical changes share one command.
+    Returns [(profile to send, [zone names])], in a stable order.
+    """
+    groups = {}
+    for zone, profile in desired.items():
+        change = diff_profile(current.get(zone), profile, partial_days)
+        if change is None:
+            continue
+        key = profile_key(change)
+        if key not in groups:
+            groups[key] = (change, [])
+        groups[key][1].append(zone)
+    return sorted(((change, sorted(zones)) for change, zones in groups.values()),
+                  key=lambda plan: plan[1])
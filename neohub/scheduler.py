@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+# Priority classes, most urgent first
+PRIORITY_WRITE = 0
+PRIORITY_LIVE = 1
+PRIORITY_BULK = 2
+
+# Reads of live state, that someone is probably waiting on
+LIVE_COMMANDS = frozenset(["INFO", "GET_ZONES", "READ_DCB", "FIRMWARE", "GET_GROUPS"])
+# Big, slow dumps that can wait
+BULK_COMMANDS = frozenset(["ENGINEERS_DATA", "GET_TEMPLOG", "STATISTICS", "READ_COMFORT_LEVELS"])
+
+
+def command_priority(cmd):
+    if cmd in BULK_COMMANDS:
+        return PRIORITY_BULK
+    if cmd in LIVE_COMMANDS:
+        return PRIORITY_LIVE
+    return PRIORITY_WRITE
+
+
+class TokenBucket(object):
+    """rate tokens per second, up to burst banked. Tokens can be taken
+    after the fact (eg bytes received), driving the balance negative."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def delay(self, amount):
+        """Seconds until amount tokens are available"""
+        self._refill()
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+
+class CommandScheduler(object):
+    """Orders and paces traffic to the hub.
+
+    Commands wait for a slot in priority order (user writes, then live
+    reads, then bulk/history reads), FIFO within a class. At most
+    max_inflight commands are outstanding at once, and at most one of them
+    a bulk read, so a burst of big dumps can't fill the pipeline ahead of
+    interactive commands.
+
+    Optionally, starts are limited to rate per second (bursting to burst),
+    and traffic to byte_rate bytes per second, counting both directions.
+
+    A scheduler created with share=<other scheduler> has its own slots and
+    queue but draws from the other's rate limits, eg one per connection to
+    the same hub.
+    """
+    def __init__(self, max_inflight=4, rate=None, burst=None, byte_rate=None, byte_burst=None, share=None):
+        self._max_inflight = max_inflight
+        if share is not None:
+            self._requests = share._requests
+            self._bytes = share._bytes
+        else:
+            self._requests = TokenBucket(rate, burst or rate) if rate else None
+            self._bytes = TokenBucket(byte_rate, byte_burst or byte_rate) if byte_rate else None
+        self._queue = []
+        self._seq = itertools.count()
+        self._inflight = 0
+        self._bulk_inflight = 0
+        self._timer = None
+
+    def slot(self, priority):
+        """async with scheduler.slot(priority) as slot: ...
+        set slot.nbytes to the bytes the command moved"""
+        return _Slot(self, priority)
+
+    async def acquire(self, priority):
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted just as we were cancelled; give it back
+                self.release(priority)
+            raise
+
+    def release(self, priority, nbytes=0):
+        self._inflight -= 1
+        if priority == PRIORITY_BULK:
+            self._bulk_inflight -= 1
+        if self._bytes is not None and nbytes:
+            self._bytes.take(nbytes)
+        self._dispatch()
+
+    def _dispatch(self):
+        queue = self._queue
+        while queue and self._inflight < self._max_inflight:
+            priority, seq, fut = queue[0]
+            if fut.done():
+                # cancelled while waiting
+                heapq.heappop(queue)
+                continue
+            if priority == PRIORITY_BULK and self._bulk_inflight:
+                # everything queued from here on is bulk too
+                return
+            delay = 0
+            if self._requests is not None:
+                delay = self._requests.delay(1)
+            if self._bytes is not None:
+                delay = max(delay, self._bytes.delay(0))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_event_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(queue)
+            if self._requests is not None:
+                self._requests.take(1)
+            self._inflight += 1
+            if priority == PRIORITY_BULK:
+                self._bulk_inflight += 1
+            fut.set_result(None)
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def waiting(self):
+        return sum(1 for p, seq, f in self._queue if not f.done())
+
+
+class _Slot(object):
+    def __init__(self, scheduler, priority):
+        self._scheduler = scheduler
+        self._priority = priority
+        self.nbytes = 0
+
+    async def __aenter__(self):
+        await self._scheduler.acquire(self._priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._scheduler.release(self._priority, self.nbytes)
@@ -0,0 +1,452 @@
+"""A stand-in NeoHub, for load testing and benchmarking without hardware.
+
+SimulatedHub serves the legacy JSON-over-TCP protocol: NUL-terminated JSON
+commands in, NUL-terminated JSON responses out, answering the commands
+NeoHub sends with the same result strings a real hub gives. It keeps a
+little state (set temperatures, frost, away, timers, locks, zone names,
+groups) so writes show up in later INFO / ENGINEERS_DATA.
+
+Misbehaviour can be dialled in: response latency, responses written in
+small chunks with a pause between each, and faults injected at random:
+dropping the connection, replying with garbage, or replying without the
+terminator.
+
+    $ python -m neohub.simulator --stats 40 --plugs 4 --latency 0.05
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import math
+import random
+
+from .history import READINGS_PER_DAY
+
+
+FIRMWARE_VERSION = 2135
+
+DEVICE_TYPE_NEOSTAT = 1
+DEVICE_TYPE_NEOPLUG = 6
+
+# Comfort level days, in a 7 day program
+_DAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+_WEEKDAYS = _DAYS[:5]
+
+# Writes that just set or clear one flag on each device they address:
+# command -> (field, value, result)
+_FLAG_COMMANDS = {
+    "FROST_ON":  ("STANDBY", True, "frost on"),
+    "FROST_OFF": ("STANDBY", False, "frost off"),
+    "AWAY_ON":   ("AWAY", True, "away on"),
+    "AWAY_OFF":  ("AWAY", False, "away off"),
+    "UNLOCK":    ("LOCK", False, "unlocked"),
+}
+
+# Writes taking [<value>, <device(s)>]: command -> (field, result)
+_VALUE_COMMANDS = {
+    "SET_TEMP":      ("CURRENT_SET_TEMPERATURE", "temperature was set"),
+    "SET_COOL_TEMP": ("COOL_TEMP", "temperature was set"),
+    "SET_FROST":     ("FROST TEMPERATURE", "temperature was set"),
+    "SET_DIFF":      ("SWITCHING DIFFERENTIAL", "switching differential was set"),
+    "SET_PREHEAT":   ("MAX PREHEAT", "max preheat was set"),
+}
+
+# Fields ENGINEERS_DATA reports; INFO reports the rest
+_ENGINEERS_FIELDS = ("DEVICE_TYPE", "DEVICE ID", "FROST TEMPERATURE",
+                     "SWITCHING DIFFERENTIAL", "MAX PREHEAT")
+
+
+def _invalid_devices(cmd):
+    return {"error": "Invalid argument to %s, should be a valid device or array of valid devices" % cmd}
+
+
+class SimulatedHub(object):
+    """An in-process fake NeoHub.
+
+    stats and plugs set how many of each device it has. latency (plus up
+    to jitter more) is how long each command takes to answer. With
+    chunk_size set, responses are written chunk_size bytes at a time,
+    chunk_delay seconds apart. drop_rate, garbage_rate and
+    unterminated_rate are the chances, per command, of closing the
+    connection instead of answering, answering with junk, or answering
+    without the terminating NUL. seed makes all of it repeatable.
+
+    requests counts commands received by name; connections counts
+    connections accepted.
+    """
+    def __init__(self, stats=8, plugs=2, latency=0.0, jitter=0.0,
+                 chunk_size=None, chunk_delay=0.0,
+                 drop_rate=0.0, garbage_rate=0.0, unterminated_rate=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.drop_rate = drop_rate
+        self.garbage_rate = garbage_rate
+        self.unterminated_rate = unterminated_rate
+        self.requests = collections.Counter()
+        self.connections = 0
+        self.format = 0
+        self.groups = {}
+        # device name -> comfort levels, once read or set
+        self.comfort_levels = {}
+
+        self._random = random.Random(seed)
+        self._server = None
+        self._writers = set()
+        self.devices = collections.OrderedDict()
+        for i in range(stats):
+            self._add_device("Zone %d" % (i + 1), DEVICE_TYPE_NEOSTAT)
+        for i in range(plugs):
+            self._add_device("Plug %d" % (i + 1), DEVICE_TYPE_NEOPLUG)
+
+    def _add_device(self, name, device_type):
+        device_id = len(self.devices) + 1
+        temperature = round(self._random.uniform(16, 22), 1)
+        self.devices[name] = {
+            "DEVICE_TYPE": device_type,
+            "DEVICE ID": device_id,
+            "FROST TEMPERATURE": 12,
+            "SWITCHING DIFFERENTIAL": 1,
+            "MAX PREHEAT": 2,
+            "CURRENT_TEMPERATURE": temperature,
+            "CURRENT_SET_TEMPERATURE": 21.0 if device_type == DEVICE_TYPE_NEOSTAT else 0.0,
+            "COOL_TEMP": 25,
+            "STANDBY": False,
+            "AWAY": False,
+            "LOCK": False,
+            "BOOST": False,
+            "TEMP_HOLD": False,
+            "HOLD_TEMPERATURE": 20,
+            "TIMER": False,
+            "TIME_CLOCK_OVERIDE_BIT": False,
+            "MANUAL_OFF": False,
+        }
+
+    # -- server
+
+    async def start(self, host="127.0.0.1", port=4242):
+        """Starts listening; port 0 picks a free port (see .port)"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+    async def wait_closed(self):
+        await self._server.wait_closed()
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        buf = b""
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data
+                while b"\0" in buf:
+                    frame, _, buf = buf.partition(b"\0")
+                    frame = frame.strip()
+                    if not frame:
+                        continue
+                    if not await self._respond(frame, writer):
+                        return
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, frame, writer):
+        """Answers one command; False if the connection should be dropped"""
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self._random.random() < self.drop_rate:
+            logging.debug("simulator: dropping connection on %s", frame[:40])
+            return False
+
+        try:
+            response = self.handle(json.loads(frame.decode()))
+        except ValueError:
+            response = {"error": "Invalid JSON"}
+        data = json.dumps(response).encode()
+
+        if self._random.random() < self.garbage_rate:
+            data = bytes(self._random.getrandbits(8) | 1 for i in range(len(data) // 2 + 1))
+        if self._random.random() >= self.unterminated_rate:
+            data += b"\0"
+
+        if self.chunk_size:
+            for i in range(0, len(data), self.chunk_size):
+                writer.write(data[i:i + self.chunk_size])
+                await writer.drain()
+                if self.chunk_delay:
+                    await asyncio.sleep(self.chunk_delay)
+        else:
+            writer.write(data)
+            await writer.drain()
+        return True
+
+    # -- commands
+
+    def handle(self, j):
+        """The response dict for one decoded command"""
+        if not isinstance(j, dict) or len(j) != 1:
+            return {"error": "Invalid command"}
+        cmd, arg = next(iter(j.items()))
+        self.requests[cmd] += 1
+        method = getattr(self, "_cmd_" + cmd.lower(), None)
+        if method is not None:
+            return method(arg)
+        if cmd in _FLAG_COMMANDS:
+            field, value, result = _FLAG_COMMANDS[cmd]
+            return self._set_field(cmd, arg, field, value, result)
+        if cmd in _VALUE_COMMANDS:
+            if not isinstance(arg, list) or len(arg) != 2:
+                return {"error": "Argument to %s should be an array [value, device(s)]" % cmd}
+            field, result = _VALUE_COMMANDS[cmd]
+            return self._set_field(cmd, arg[1], field, arg[0], result)
+        return {"error": "Unknown command %s" % cmd}
+
+    def _resolve(self, arg):
+        """Device names for a <device(s)> argument (names, zone numbers or
+        groups), or None if any of them isn't a device"""
+        if not isinstance(arg, list):
+            arg = [arg]
+        ids = dict((fields["DEVICE ID"], name) for name, fields in self.devices.items())
+        names = []
+        for device in arg:
+            if isinstance(device, int) and not isinstance(device, bool):
+                device = ids.get(device)
+            if device in self.groups:
+                names.extend(self.groups[device])
+                continue
+            if device not in self.devices:
+                return None
+            names.append(device)
+        return names
+
+    def _set_field(self, cmd, arg, field, value, result):
+        names = self._resolve(arg)
+        if names is None:
+            return _invalid_devices(cmd)
+        for name in names:
+            self.devices[name][field] = value
+        return {"result": result}
+
+    def _cmd_get_zones(self, arg):
+        return dict((name, fields["DEVICE ID"]) for name, fields in self.devices.items())
+
+    def _cmd_read_dcb(self, arg):
+        return {"CORF": "C", "FIRMWARE": FIRMWARE_VERSION, "NEOSTAT_COUNT": len(self.devices)}
+
+    def _cmd_firmware(self, arg):
+        return {"firmware version": str(FIRMWARE_VERSION)}
+
+    def _cmd_info(self, arg):
+        devices = []
+        for name, fields in self.devices.items():
+            heating = (fields["DEVICE_TYPE"] == DEVICE_TYPE_NEOSTAT and not fields["STANDBY"]
+                       and fields["CURRENT_TEMPERATURE"] < fields["CURRENT_SET_TEMPERATURE"])
+            dev = {"device": name, "HEATING": heating}
+            for field, value in fields.items():
+                if field in _ENGINEERS_FIELDS and field != "DEVICE_TYPE":
+                    continue
+                if field in ("CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE"):
+                    # the hub sends temperatures as strings
+                    value = "%0.1f" % value
+                dev[field] = value
+            devices.append(dev)
+        return {"devices": devices}
+
+    def _cmd_engineers_data(self, arg):
+        return dict((name, dict((field, fields[field]) for field in _ENGINEERS_FIELDS))
+                    for name, fields in self.devices.items())
+
+    def _cmd_get_templog(self, arg):
+        names = self._resolve(arg)
+        if names is None:
+            return _invalid_devices("GET_TEMPLOG")
+        result = {}
+        for key, count in (("day:2", READINGS_PER_DAY), ("day:1", READINGS_PER_DAY), ("today", READINGS_PER_DAY // 2)):
+            day = {}
+            for name in names:
+                fields = self.devices[name]
+                base = fields["CURRENT_TEMPERATURE"]
+                phase = fields["DEVICE ID"]
+                day[name] = [round(base + 1.5 * math.sin((i + phase) * 2 * math.pi / READINGS_PER_DAY), 1)
+                             for i in range(count)]
+            result[key] = day
+        return result
+
+    def _cmd_timer_on(self, arg):
+        names = self._resolve(arg)
+        if names is None:
+            return _invalid_devices("TIMER_ON")
+        for name in names:
+            self.devices[name]["TIMER"] = True
+            self.devices[name]["TIME_CLOCK_OVERIDE_BIT"] = True
+        return {"result": "time clock overide on"}
+
+    def _cmd_timer_off(self, arg):
+        names = self._resolve(arg)
+        if names is None:
+            return _invalid_devices("TIMER_OFF")
+        for name in names:
+            self.devices[name]["TIMER"] = False
+            self.devices[name]["TIME_CLOCK_OVERIDE_BIT"] = False
+        return {"result": "timers off"}
+
+    def _cmd_lock(self, arg):
+        if not isinstance(arg, list) or len(arg) != 2:
+            return {"error": "Argument to LOCK should be an array [pin, device(s)]"}
+        return self._set_field("LOCK", arg[1], "LOCK", True, "locked")
+
+    def _cmd_boost_on(self, arg):
+        if not isinstance(arg, list) or len(arg) != 2:
+            return {"error": "Argument to BOOST_ON should be an array [interval, device(s)]"}
+        return self._set_field("BOOST_ON", arg[1], "BOOST", True, "boost on")
+
+    def _cmd_boost_off(self, arg):
+        if not isinstance(arg, list) or len(arg) != 2:
+            return {"error": "Argument to BOOST_OFF should be an array [interval, device(s)]"}
+        return self._set_field("BOOST_OFF", arg[1], "BOOST", False, "boost off")
+
+    def _cmd_set_format(self, arg):
+        self.format = arg
+        return {"result": "Format was set"}
+
+    def _cmd_get_groups(self, arg):
+        return dict((name, list(members)) for name, members in self.groups.items())
+
+    def _cmd_create_group(self, arg):
+        if not isinstance(arg, list):
+            return {"error": "Argument to CREATE_GROUP should be an array"}
+        if len(arg) != 2:
+            return {"error": "array for CREATE_GROUP should be size 2 [devices,groupname]"}
+        names = self._resolve(arg[0]) if isinstance(arg[0], list) else None
+        if names is None:
+            return {"error": "first argument to CREATE_GROUP should be an array of devices"}
+        if not isinstance(arg[1], str):
+            return {"error": "second argument to CREATE_GROUP should be a string (group name)"}
+        self.groups[arg[1]] = names
+        return {"result": "group created"}
+
+    def _cmd_delete_group(self, arg):
+        if not isinstance(arg, str):
+            return {"error": "Argument to DELETE_GROUP should be a string"}
+        self.groups.pop(arg, None)
+        return {"result": "group removed"}
+
+    def _comfort_levels(self, name):
+        if name not in self.comfort_levels:
+            self.comfort_levels[name] = dict((day, {
+                "wake": ["07:00", 21],
+                "leave": ["09:00", 16] if day in _WEEKDAYS else ["09:00", 21],
+                "return": ["17:00", 21],
+                "sleep": ["22:00", 16],
+            }) for day in _DAYS)
+        return self.comfort_levels[name]
+
+    def _cmd_read_comfort_levels(self, arg):
+        names = self._resolve(arg)
+        if names is None:
+            return {"error": "Invalid argument to READ_COMFORT_LEVELS, should be a valid device or array of valid devices"}
+        return dict((name, json.loads(json.dumps(self._comfort_levels(name)))) for name in names)
+
+    def _cmd_set_comfort_levels(self, arg):
+        if not isinstance(arg, list) or len(arg) != 2:
+            return {"error": "Argument to SET_COMFORT_LEVELS should be an array [comfort levels, device(s)]"}
+        levels, devices = arg
+        if not isinstance(levels, dict) or any(day not in _DAYS or not isinstance(day_levels, dict)
+                                               for day, day_levels in levels.items()):
+            return {"error": "first argument to SET_COMFORT_LEVELS should be {day: {level: [time, temperature]}}"}
+        names = self._resolve(devices)
+        if names is None:
+            return {"error": "second argument to SET_COMFORT_LEVELS should be a valid device or array of valid devices"}
+        for name in names:
+            self._comfort_levels(name).update(json.loads(json.dumps(levels)))
+        return {"result": "comfort levels set"}
+
+    def _cmd_zone_title(self, arg):
+        if not isinstance(arg, list):
+            return {"error": "Argument to ZONE_TITLE should be an array"}
+        if len(arg) != 2:
+            return {"error": "array for ZONE_TITLE should be size 2 [oldname,newname]"}
+        old, new = arg
+        if old not in self.devices:
+            return {"error": "first argument to ZONE_TITLE should be a device"}
+        if not isinstance(new, str):
+            return {"error": "second argument to ZONE_TITLE should be a string (new device name)"}
+        # keep zone order, as the hub does
+        self.devices = collections.OrderedDict(
+            (new if name == old else name, fields) for name, fields in self.devices.items())
+        for members in self.groups.values():
+            members[:] = [new if name == old else name for name in members]
+        if old in self.comfort_levels:
+            self.comfort_levels[new] = self.comfort_levels.pop(old)
+        return {"result": "zone renamed"}
+
+    def _cmd_remove_zone(self, arg):
+        if arg not in self.devices:
+            return {"error": "Invalid argument to REMOVE_ZONE, should be a valid device"}
+        del self.devices[arg]
+        self.comfort_levels.pop(arg, None)
+        for members in self.groups.values():
+            if arg in members:
+                members.remove(arg)
+        return {"result": "zone removed"}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated NeoHub, speaking the legacy JSON API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4242)
+    parser.add_argument("--stats", type=int, default=8, help="number of neostats")
+    parser.add_argument("--plugs", type=int, default=2, help="number of neoplugs")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to answer each command")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds")
+    parser.add_argument("--chunk-size", type=int, default=None, help="write responses this many bytes at a time")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between chunks")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="chance of dropping the connection")
+    parser.add_argument("--garbage-rate", type=float, default=0.0, help="chance of a garbage response")
+    parser.add_argument("--unterminated-rate", type=float, default=0.0, help="chance of leaving off the NUL")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    hub = SimulatedHub(stats=args.stats, plugs=args.plugs, latency=args.latency, jitter=args.jitter,
+                       chunk_size=args.chunk_size, chunk_delay=args.chunk_delay,
+                       drop_rate=args.drop_rate, garbage_rate=args.garbage_rate,
+                       unterminated_rate=args.unterminated_rate, seed=args.seed)
+
+    async def serve():
+        await hub.start(args.host, args.port)
+        logging.info("Simulated NeoHub with %d devices on %s:%d", len(hub.devices), args.host, hub.port)
+        await hub.serve_forever()
+
+    try:
+        asyncio.get_event_loop().run_until_complete(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+# Bump when the layout changes; snapshots of any other version are ignored.
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(path, host, port, zones, dcb, devices):
+    """Atomically writes a snapshot of a hub's zones, DCB and device state"""
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "host": host,
+        "port": port,
+        "saved": time.time(),
+        "zones": zones,
+        "dcb": dcb,
+        "devices": devices,
+    }
+    atomic_write(path, json.dumps(data, separators=(",", ":")))
+
+
+def atomic_write(path, text):
+    """Replaces path with text (or bytes), such that a crash leaves either
+    the old file or the new one, never half of one"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".neohub-")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(text, bytes) else "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_snapshot(path, host, port):
+    """Returns the snapshot dict saved for host:port, or None if there isn't
+    a usable one"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable NeoHub snapshot %s: %s", path, e)
+        return None
+    if data.get("version") != SNAPSHOT_VERSION or data.get("host") != host or data.get("port") != port:
+        return None
+    return data
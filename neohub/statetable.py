@@ -0,0 +1,342 @@
+import array
+import collections.abc
+import math
+
+from .changes import Change
+
+
+_MISSING = object()
+
+# The hub sends these as strings, eg "21.5". They're also kept parsed, in
+# a float array per field, so queries over them don't re-parse every row.
+TEMPERATURE_FIELDS = frozenset(["CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE",
+                                "CURRENT_FLOOR_TEMPERATURE", "HOLD_TEMPERATURE"])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class _Column(object):
+    """One field across all rows: a typed array while every value seen has
+    the same simple type, else a plain list. present marks which rows have
+    a value at all."""
+    __slots__ = ("kind", "values", "present")
+
+    def __init__(self, kind, nrows):
+        self.kind = kind
+        if kind == "o":
+            self.values = [None] * nrows
+        else:
+            self.values = array.array(kind, bytes(array.array(kind).itemsize * nrows))
+        self.present = bytearray(nrows)
+
+    def get(self, row):
+        value = self.values[row]
+        if self.kind == "b":
+            return bool(value)
+        return value
+
+    def to_objects(self):
+        values = [self.get(row) for row in range(len(self.present))]
+        self.kind = "o"
+        self.values = values
+
+
+def _kind_of(value):
+    # bool before int: bool is a subclass of int
+    if type(value) is bool:
+        return "b"
+    if type(value) is int and -2**63 <= value < 2**63:
+        return "q"
+    if type(value) is float:
+        return "d"
+    return "o"
+
+
+class StateTable(collections.abc.Mapping):
+    """Device state, stored column-wise: one column per field, one row per
+    device, updated in place on every refresh.
+
+    Behaves as a read-only dict of {device name: row}, where each row is a
+    dict-like view onto that device's fields, so existing code indexing
+    hub.devices[name][field] keeps working. Whole-column queries (below(),
+    count(), max_by_group() and friends) run over the typed arrays without
+    building a dict per device. TEMPERATURE_FIELDS are read back as the
+    hub sent them, but queried as floats parsed when they were written.
+    """
+    def __init__(self):
+        self._rows = {}
+        self._names = []
+        self._columns = {}
+        # field -> array("d") of TEMPERATURE_FIELDS parsed, NaN if missing
+        self._parsed = {}
+        self._views = {}
+
+    # -- Mapping of name -> row view
+
+    def __getitem__(self, name):
+        view = self._views.get(name)
+        if view is None:
+            if name not in self._rows:
+                raise KeyError(name)
+            view = self._views[name] = RowView(self, name)
+        return view
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __repr__(self):
+        return "<StateTable %d devices x %d fields>" % (len(self._names), len(self._columns))
+
+    # -- rows
+
+    def add_row(self, name):
+        if name in self._rows:
+            return self._rows[name]
+        row = len(self._names)
+        self._rows[name] = row
+        self._names.append(name)
+        for column in self._columns.values():
+            if column.kind == "o":
+                column.values.append(None)
+            else:
+                column.values.append(0)
+            column.present.append(0)
+        for values in self._parsed.values():
+            values.append(math.nan)
+        return row
+
+    def remove_row(self, name):
+        # move the last row into the hole, so rows stay dense
+        row = self._rows.pop(name)
+        self._views.pop(name, None)
+        last = len(self._names) - 1
+        if row != last:
+            moved = self._names[last]
+            self._names[row] = moved
+            self._rows[moved] = row
+            for column in self._columns.values():
+                column.values[row] = column.values[last]
+                column.present[row] = column.present[last]
+            for values in self._parsed.values():
+                values[row] = values[last]
+        self._names.pop()
+        for column in self._columns.values():
+            column.values.pop()
+            column.present.pop()
+        for values in self._parsed.values():
+            values.pop()
+
+    def rename_row(self, old, new):
+        row = self._rows.pop(old)
+        self._views.pop(old, None)
+        self._rows[new] = row
+        self._names[row] = new
+
+    def names(self):
+        return list(self._names)
+
+    def to_dict(self):
+        """A plain {name: {field: value}} copy, eg for JSON"""
+        return dict((name, self[name].copy()) for name in self._names)
+
+    # -- cells
+
+    def get(self, name, field, default=None):
+        column = self._columns.get(field)
+        row = self._rows[name]
+        if column is None or not column.present[row]:
+            return default
+        return column.get(row)
+
+    def has(self, name, field):
+        column = self._columns.get(field)
+        return column is not None and bool(column.present[self._rows[name]])
+
+    def set(self, name, field, value):
+        self._set(self._rows[name], field, value)
+
+    def _set(self, row, field, value):
+        column = self._columns.get(field)
+        kind = _kind_of(value)
+        if column is None:
+            column = self._columns[field] = _Column(kind, len(self._names))
+        elif column.kind != kind and column.kind != "o":
+            column.to_objects()
+        column.values[row] = value
+        column.present[row] = 1
+        if field in TEMPERATURE_FIELDS:
+            parsed = self._parsed.get(field)
+            if parsed is None:
+                parsed = self._parsed[field] = array.array("d", [math.nan]) * len(self._names)
+            parsed[row] = _to_float(value)
+
+    def unset(self, name, field):
+        column = self._columns.get(field)
+        row = self._rows[name]
+        if column is None or not column.present[row]:
+            raise KeyError(field)
+        column.present[row] = 0
+        if column.kind == "o":
+            column.values[row] = None
+        if field in self._parsed:
+            self._parsed[field][row] = math.nan
+
+    def fields(self, name):
+        row = self._rows[name]
+        return [field for field, column in self._columns.items() if column.present[row]]
+
+    def update_row(self, name, fields, changes=None):
+        """Merges a dict of fields into a row. If changes is a list, a
+        Change is appended to it for each field whose value changed."""
+        row = self._rows[name]
+        columns = self._columns
+        for field, value in fields.items():
+            column = columns.get(field)
+            if column is not None and column.present[row]:
+                old = column.get(row)
+                if old == value and type(old) is type(value):
+                    continue
+            else:
+                old = None
+            self._set(row, field, value)
+            if changes is not None:
+                changes.append(Change(name, field, old, value))
+
+    # -- columns and vectorized queries
+
+    def column(self, field):
+        """(values, present) for a field: values is the underlying array (or
+        list) with one entry per row, in names() order"""
+        column = self._columns[field]
+        return column.values, column.present
+
+    def numeric(self, field):
+        """A field as an array of floats, NaN where missing or not a number.
+        Handy for temperatures, which the hub sends as strings."""
+        parsed = self._parsed.get(field)
+        if parsed is not None:
+            return array.array("d", parsed)
+        column = self._columns.get(field)
+        if column is None:
+            return array.array("d", [math.nan] * len(self._names))
+        if column.kind in ("d", "q", "b"):
+            out = array.array("d", column.values)
+            for row in range(len(out)):
+                if not column.present[row]:
+                    out[row] = math.nan
+            return out
+        out = array.array("d", bytes(8 * len(self._names)))
+        for row, value in enumerate(column.values):
+            try:
+                out[row] = float(value) if column.present[row] else math.nan
+            except (TypeError, ValueError):
+                out[row] = math.nan
+        return out
+
+    def below(self, field, other):
+        """Names of devices where field < other, other being a field name or
+        a number, eg table.below("CURRENT_TEMPERATURE", "CURRENT_SET_TEMPERATURE")"""
+        a = self.numeric(field)
+        if isinstance(other, str):
+            b = self.numeric(other)
+        else:
+            b = array.array("d", [other]) * len(a)
+        names = self._names
+        return [names[row] for row, (x, y) in enumerate(zip(a, b)) if x < y]
+
+    def above(self, field, other):
+        a = self.numeric(field)
+        if isinstance(other, str):
+            b = self.numeric(other)
+        else:
+            b = array.array("d", [other]) * len(a)
+        names = self._names
+        return [names[row] for row, (x, y) in enumerate(zip(a, b)) if x > y]
+
+    def where(self, field, value=True):
+        """Names of devices where field == value"""
+        column = self._columns.get(field)
+        if column is None:
+            return []
+        names = self._names
+        present = column.present
+        return [names[row] for row, v in enumerate(column.values) if present[row] and v == value]
+
+    def count(self, field, value=True):
+        """Number of devices where field == value, eg count("HEATING")"""
+        column = self._columns.get(field)
+        if column is None:
+            return 0
+        present = column.present
+        return sum(1 for row, v in enumerate(column.values) if present[row] and v == value)
+
+    def max_by_group(self, field, groups):
+        """{group: max of field over its members}; groups maps group name to
+        a list of device names. Groups with no numeric values are left out."""
+        values = self.numeric(field)
+        rows = self._rows
+        result = {}
+        for group, members in groups.items():
+            vals = [values[rows[name]] for name in members if name in rows]
+            vals = [v for v in vals if not math.isnan(v)]
+            if vals:
+                result[group] = max(vals)
+        return result
+
+
+class RowView(collections.abc.MutableMapping):
+    """One device's fields, as a dict-like view onto its StateTable row"""
+    __slots__ = ("_table", "_name")
+
+    def __init__(self, table, name):
+        self._table = table
+        self._name = name
+
+    def __getitem__(self, field):
+        value = self._table.get(self._name, field, _MISSING)
+        if value is _MISSING:
+            raise KeyError(field)
+        return value
+
+    def get(self, field, default=None):
+        return self._table.get(self._name, field, default)
+
+    def __contains__(self, field):
+        return self._table.has(self._name, field)
+
+    def __setitem__(self, field, value):
+        self._table.set(self._name, field, value)
+
+    def __delitem__(self, field):
+        self._table.unset(self._name, field)
+
+    def __iter__(self):
+        return iter(self._table.fields(self._name))
+
+    def __len__(self):
+        return len(self._table.fields(self._name))
+
+    def update(self, fields=(), **kwargs):
+        self._table.update_row(self._name, dict(fields, **kwargs))
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(dict(self.items()))